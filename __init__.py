@@ -1,5 +1,15 @@
+from async_fetch import AsyncFetcher
+from cache import ResponseCache
 from clean import clean
+from constituents import Constituents
+from governor import Governor
 from obtain import Obtain
+from panel import build_panel, PanelStore
+from pipeline import ParsePool
+from planner import plan_requests
+from sessions import SessionPool
+from sinks import CSVSink, ParquetSink, CallbackSink
+from stats import stats, JSONLinesHook, ChromeTraceHook
 from utils import fetch, robust_fetch
 
 
@@ -0,0 +1,73 @@
+"""
+async_fetch.py
+
+Non-blocking requests to Datastream.  The calls return straight away
+and the work is done by a limited number of background threads, each
+with its own session from a SessionPool.
+"""
+from multiprocessing.pool import ThreadPool
+
+from sessions import SessionPool
+
+class AsyncFetcher(object):
+    def __init__(self, max_concurrent=4, sessions=None):
+        """
+        Runs Obtain.fetch in the background.
+
+        Parameters:
+        -----------
+        max_concurrent: int
+            Largest number of requests in flight at once.
+        sessions: SessionPool (optional)
+            Where the Obtain sessions come from.  By default a pool
+            of max_concurrent sessions is made.
+        """
+        if sessions is None:
+            sessions = SessionPool(size=max_concurrent)
+        self.sessions = sessions
+        self._pool = ThreadPool(max_concurrent)
+
+    def _fetch(self, args):
+        codes, kwargs = args
+        with self.sessions.session() as o:
+            return o.fetch(codes, **kwargs)
+
+    def fetch(self, codes, callback=None, error_callback=None, **kwargs):
+        """
+        Starts Obtain.fetch(codes, **kwargs) and returns at once.
+
+        Returns an AsyncResult: use ready() to check whether it is done
+        and get(timeout) to wait for the RawData (errors are raised
+        there).  callback(rawdata) is called from the worker thread
+        when the request finishes, error_callback(exception) if it
+        fails.  Event loops should hand these over to their own
+        thread (e.g. with IOLoop.add_callback).
+        """
+        def run(args):
+            try:
+                return self._fetch(args)
+            except Exception as e:
+                if error_callback is not None:
+                    error_callback(e)
+                raise
+
+        return self._pool.apply_async(run, ((codes, kwargs),),
+                callback=callback)
+
+    def imap(self, chunks, ordered=True, **kwargs):
+        """
+        Fetches every chunk of codes, max_concurrent at a time, and
+        yields the RawData as they arrive.  With ordered=True they are
+        yielded in the same order as chunks.
+        """
+        work = ((list(chunk), kwargs) for chunk in chunks)
+        if ordered:
+            return self._pool.imap(self._fetch, work)
+        return self._pool.imap_unordered(self._fetch, work)
+
+    def close(self):
+        """
+        Waits for the requests in flight, then stops the threads.
+        """
+        self._pool.close()
+        self._pool.join()
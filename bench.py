@@ -0,0 +1,302 @@
+"""
+bench.py
+
+Benchmarks that need no DataWorks account.  A fake Datastream makes
+up responses shaped like the real ones (many codes, _2.._16 suffixed
+fields, ArrayValue series and INSTERROR codes) and the usual code
+paths are timed against it.  Each benchmark runs in its own process
+so that its peak memory can be reported.
+
+    python bench.py --codes 2000 --points 2500 --latency 0.05
+
+pydatastream still has to be installed, since obtain.py imports it,
+but it is never asked to connect, except by the --connect benchmarks
+of start-up time.
+"""
+import os
+import sys
+import time
+import subprocess
+import zlib
+import random
+import argparse
+import resource
+import datetime as dt
+import multiprocessing
+
+import pandas as pd
+
+import utils
+from cache import Record
+from clean import clean
+from obtain import Obtain, RawData
+from sessions import SessionPool
+from streamer import streamer
+
+class FakeDatastream(object):
+    def __init__(self, points=2500, error_rate=0.02, latency=0., seed=0):
+        """
+        Makes up responses to Datastream requests.
+
+        Parameters:
+        -----------
+        points: int
+            Length of every series.
+        error_rate: float
+            Share of codes that come back as INSTERROR.
+        latency: float
+            Seconds every request takes, to stand in for the network.
+        seed: int
+        """
+        self.points = points
+        self.error_rate = error_rate
+        self.latency = latency
+        self.seed = seed
+        self.requests = 0
+        start = dt.datetime(2016, 1, 1) - dt.timedelta(days=int(points*1.4))
+        self._dates = [d.to_pydatetime() for d in
+                pd.bdate_range(start, periods=points)]
+
+    def is_error(self, code):
+        """ Whether code comes back as INSTERROR, fixed for each code. """
+        return (zlib.crc32(code) % 10000) < self.error_rate*10000
+
+    def response(self, query):
+        """
+        A response to a request string made by Obtain._construct_request.
+        """
+        self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        parts = query.split('~')
+        codes = parts[0].split(',')
+        fields = ['P']
+        for part in parts[1:]:
+            if part.startswith('='):
+                fields = part[1:].split(',')
+        static = parts[-1] == 'REP'
+
+        rng = random.Random(hash((self.seed, query)))
+        items = []
+        for k, code in enumerate(codes):
+            suffix = '' if k == 0 else '_{}'.format(k+1)
+            if self.is_error(code):
+                items.append(self._field('INSTERROR'+suffix, '$$"ER", E100'))
+                continue
+            if static:
+                for field in fields:
+                    items.append(self._field(field+suffix,
+                        u'{} {}'.format(field, code)))
+                continue
+            items.append(self._field('DATE'+suffix, array=self._dates))
+            for field in fields:
+                level = 100.*rng.random()
+                series = []
+                for i in xrange(self.points):
+                    level *= 1 + rng.gauss(0, 0.01)
+                    series.append(level)
+                # Some missing values, like real series have.
+                for i in xrange(self.points//100):
+                    series[rng.randrange(self.points)] = None
+                items.append(self._field(field+suffix, array=series))
+            items.append(self._field('CCY'+suffix, u'U$'))
+            items.append(self._field('DISPNAME'+suffix, u'FAKE ' + code))
+            items.append(self._field('FREQUENCY'+suffix, u'D'))
+            items.append(self._field('SYMBOL'+suffix, unicode(code)))
+
+        return Record([
+            ('Source', u'Datastream'),
+            ('Instrument', unicode(query)),
+            ('StatusType', u'Connected'),
+            ('StatusCode', 0),
+            ('StatusMessage', None),
+            ('Fields', Record([('Field', items)])),
+            ])
+
+    @staticmethod
+    def _field(name, value=None, array=None):
+        if array is not None:
+            return Record([('Name', name),
+                ('ArrayValue', Record([('anyType', array)]))])
+        return Record([('Name', name), ('Value', value)])
+
+class FakeObtain(Obtain):
+    """
+    Obtain that talks to a FakeDatastream instead of DataWorks.
+    """
+    def __init__(self, server, cache=None, governor=None):
+        self.server = server
+        self.cache = cache
+        self.governor = governor
+
+    def _send(self, query, *args, **kwargs):
+        return self.server.response(query)
+
+class FakeDWE(object):
+    """
+    Stands in for pydatastream's Datastream in streamer.  fetch()
+    returns what pydatastream would: a DataFrame of fields by date.
+    """
+    def __init__(self, server):
+        self.server = server
+
+    def request(self, query, *args, **kwargs):
+        return self.server.response(query)
+
+    def fetch(self, code, fields=None, date_from=None, **kwargs):
+        if fields is None:
+            fields = ['P']
+        raw = list(self.server.response(Obtain._construct_request(code,
+            fields=fields)))
+        raw.append([code])
+        data = RawData(raw).data
+        if data is None or 'DATE' not in data[0][1]:
+            raise Exception("No data for {}".format(code))
+        df = pd.DataFrame(data[0][1]).set_index('DATE')
+        return df[[f for f in fields if f in df.columns]]
+
+def codes_for(n):
+    return ['FAKE{:05d}'.format(i) for i in xrange(n)]
+
+def responses_for(server, codes, fields):
+    raws = []
+    for chunk in utils.chunks(codes, 16):
+        raw = list(server.response(Obtain._construct_request(chunk,
+            fields=fields, freq='D')))
+        raw.append(chunk)
+        raws.append(raw)
+    return raws
+
+def bench_rawdata(args, compact=False):
+    server = FakeDatastream(args.points, args.error_rate)
+    raws = responses_for(server, codes_for(args.codes), args.fields)
+    start = time.time()
+    for raw in raws:
+        RawData(raw, compact=compact)
+    return time.time() - start
+
+def bench_clean(args, fast=True, compact=False, **kwargs):
+    server = FakeDatastream(args.points, args.error_rate)
+    raws = [RawData(raw, compact=compact) for raw in
+            responses_for(server, codes_for(args.codes), args.fields)]
+    start = time.time()
+    df = clean(raws, fast=fast, **kwargs)
+    seconds = time.time() - start
+    print 'clean {}: {:.1f} MB DataFrame'.format(kwargs,
+            df.memory_usage(deep=True).sum()/1024.**2)
+    return seconds
+
+def bench_obtain_fetch(args):
+    o = FakeObtain(FakeDatastream(args.points, args.error_rate, args.latency))
+    start = time.time()
+    for chunk in utils.chunks(codes_for(args.codes), 16):
+        o.fetch(chunk, fields=args.fields)
+    return time.time() - start
+
+def bench_utils_fetch(args, threaded=False, processes=0):
+    workers = args.workers if threaded else 1
+    server = FakeDatastream(args.points, args.error_rate, args.latency)
+    sessions = SessionPool(size=workers, factory=lambda: FakeObtain(server))
+    start = time.time()
+    utils.fetch(codes_for(args.codes), 16, max_workers=workers,
+            sessions=sessions, fields=args.fields, processes=processes)
+    return time.time() - start
+
+def bench_streamer_fetch(args, batch=True):
+    s = streamer.__new__(streamer)
+    s.DWE = FakeDWE(FakeDatastream(args.points, args.error_rate,
+        args.latency))
+    start = time.time()
+    s.fetch(codes_for(args.codes), fields=args.fields, batch=batch)
+    return time.time() - start
+
+def bench_import(args, module):
+    """ Seconds to import module in a fresh interpreter. """
+    code = ('import time; start = time.time(); import {}; '
+            'print time.time() - start').format(module)
+    out = subprocess.check_output([sys.executable, '-c', code],
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+    return float(out.split()[-1])
+
+def bench_connect(args):
+    """
+    Seconds to make args.workers Obtain sessions.  This one does
+    connect to Datastream, so it needs an account in ~/.netrc.
+    """
+    start = time.time()
+    for i in xrange(args.workers):
+        Obtain()
+    return time.time() - start
+
+BENCHMARKS = [
+        ('import obtain', bench_import, {'module': 'obtain'}),
+        ('import streamer', bench_import, {'module': 'streamer'}),
+        ('RawData', bench_rawdata, {}),
+        ('RawData compact', bench_rawdata, {'compact': True}),
+        ('clean', bench_clean, {'fast': False}),
+        ('clean fast', bench_clean, {}),
+        ('clean fast compact', bench_clean, {'compact': True}),
+        ('clean compact dtypes', bench_clean, {'compact_dtypes': True}),
+        ('clean compact float32', bench_clean, {'compact_dtypes': True,
+            'float32': True}),
+        ('Obtain.fetch', bench_obtain_fetch, {}),
+        ('utils.fetch', bench_utils_fetch, {}),
+        ('utils.fetch threaded', bench_utils_fetch, {'threaded': True}),
+        ('utils.fetch processes', bench_utils_fetch, {'threaded': True,
+            'processes': multiprocessing.cpu_count()}),
+        ('streamer.fetch', bench_streamer_fetch, {}),
+        ('streamer.fetch one by one', bench_streamer_fetch, {'batch': False}),
+        ]
+
+# Benchmarks that need a Datastream account, run with --connect.
+CONNECT_BENCHMARKS = [
+        ('Obtain()', bench_connect, {}),
+        ]
+
+def _run(func, args, kwargs, queue):
+    seconds = func(args, **kwargs)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put((seconds, peak))
+
+def run(args, names=None, benchmarks=BENCHMARKS):
+    """
+    Runs the benchmarks (all of them, or those in names), each in a
+    new process.  Returns a DataFrame of the results.
+    """
+    rows = []
+    for name, func, kwargs in benchmarks:
+        if names and name not in names:
+            continue
+        queue = multiprocessing.Queue()
+        p = multiprocessing.Process(target=_run,
+                args=(func, args, kwargs, queue))
+        p.start()
+        seconds, peak = queue.get()
+        p.join()
+        points = args.codes*args.points*len(args.fields)
+        rows.append({'benchmark': name, 'seconds': seconds,
+            'codes/s': args.codes/seconds, 'points/s': points/seconds,
+            # ru_maxrss is in kilobytes on Linux.
+            'peak MB': peak/1024.})
+    return pd.DataFrame(rows, columns=['benchmark', 'seconds', 'codes/s',
+        'points/s', 'peak MB'])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[1])
+    parser.add_argument('--codes', type=int, default=500)
+    parser.add_argument('--points', type=int, default=2500)
+    parser.add_argument('--fields', nargs='+', default=['P', 'MV'])
+    parser.add_argument('--error-rate', type=float, default=0.02)
+    parser.add_argument('--latency', type=float, default=0.,
+            help='seconds added to every request')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--only', nargs='+', default=None,
+            help='names of the benchmarks to run')
+    parser.add_argument('--connect', action='store_true',
+            help='also time making sessions (needs an account)')
+    args = parser.parse_args(argv)
+    benchmarks = BENCHMARKS + (CONNECT_BENCHMARKS if args.connect else [])
+    print run(args, args.only, benchmarks).to_string(index=False)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+"""
+cache.py
+
+A small on-disk cache for Datastream responses.  Responses are
+stored one file per request string, so several processes can share
+the same directory.
+"""
+import os
+import time
+import errno
+import hashlib
+import tempfile
+import cPickle as pickle
+
+# How long (in seconds) a response is good for, by frequency.
+# Static requests change rarely, daily data changes every day.
+DEFAULT_TTL = {
+        'D': 12*60*60,
+        'W': 24*60*60,
+        'M': 7*24*60*60,
+        'REP': 30*24*60*60,
+        None: 12*60*60,
+        }
+
+class Record(object):
+    """
+    Plain Python stand-in for the suds objects that pydatastream
+    returns.  Like the suds object it can be iterated over as
+    (name, value) pairs and indexed by position or by name, so
+    RawData cannot tell the difference.  Unlike suds objects it
+    pickles cleanly.
+    """
+    def __init__(self, items):
+        self._keys = [k for k, v in items]
+        self._values = dict(items)
+
+    def __iter__(self):
+        for k in self._keys:
+            yield k, self._values[k]
+
+    def __getitem__(self, name):
+        if isinstance(name, int):
+            name = self._keys[name]
+        return self._values[name]
+
+    def __getattr__(self, name):
+        try:
+            return self.__dict__['_values'][name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __repr__(self):
+        return "Record({})".format(self._keys)
+
+def to_plain(obj):
+    """
+    Recursively converts a suds response into Records and lists.
+    """
+    if hasattr(obj, '__keylist__'):
+        return Record([(k, to_plain(getattr(obj, k))) for k in obj.__keylist__])
+    elif isinstance(obj, (list, tuple)):
+        return [to_plain(item) for item in obj]
+    else:
+        return obj
+
+def request_freq(query):
+    """
+    Gets the frequency from a request made by Obtain._construct_request.
+    The frequency, if there is one, is always the last ~ section.
+    """
+    freq = query.rsplit('~', 1)[-1] if '~' in query else None
+    if freq in ('D', 'W', 'M', 'REP'):
+        return freq
+    return None
+
+class ResponseCache(object):
+    def __init__(self, path="~/.datastream_cache/", ttl=None,
+            max_bytes=1024**3):
+        """
+        Caches responses to Datastream requests on disk.
+
+        Parameters:
+        -----------
+        path: str
+            Directory to keep the cache in.  It is created if needed.
+        ttl: dict (optional)
+            Seconds that a response stays fresh, keyed by frequency
+            ('D', 'W', 'M', 'REP' and None for anything else).
+            Entries update DEFAULT_TTL.
+        max_bytes: int
+            Size of the cache.  When it is exceeded the least recently
+            used responses are removed, down to 90% of max_bytes.
+            The directory is only looked through when the bytes this
+            process has written take it over max_bytes, so a cache
+            shared by several processes can go over it for a while.
+        """
+        self.path = os.path.expanduser(path)
+        self.ttl = dict(DEFAULT_TTL)
+        if ttl is not None:
+            self.ttl.update(ttl)
+        self.max_bytes = max_bytes
+        self._total = None # bytes in the cache, None until first counted
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _file(self, key):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return os.path.join(self.path, hashlib.sha1(key).hexdigest() + '.pkl')
+
+    def get(self, key):
+        """
+        Returns the cached response for key, or None if there is no
+        fresh copy.
+        """
+        fname = self._file(key)
+        try:
+            with open(fname, 'rb') as f:
+                stored_key, created, value = pickle.load(f)
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        if time.time() - created > self.ttl.get(request_freq(key),
+                self.ttl[None]):
+            self._remove(fname)
+            return None
+        try:
+            # Bump the access time for the LRU policy.
+            os.utime(fname, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, response):
+        """
+        Stores a response and returns the plain (picklable) version
+        of it.  Responses that did not connect are not stored.
+        """
+        value = to_plain(response)
+        if dict(value).get('StatusType') == 'Connected':
+            self.store(key, value)
+        return value
+
+    def store(self, key, value):
+        """
+        Stores any picklable value under key.
+        """
+        # Write to a temporary file and rename it into place so that
+        # readers never see half of a file.
+        fname = self._file(key)
+        try:
+            replaced = os.path.getsize(fname)
+        except OSError:
+            replaced = 0
+        fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump((key, time.time(), value), f,
+                        pickle.HIGHEST_PROTOCOL)
+                size = f.tell()
+            os.rename(tmp, fname)
+        except:
+            self._remove(tmp)
+            raise
+        # Keep a running total rather than stat every file on every
+        # store, which would make filling the cache quadratic.
+        if self._total is not None:
+            self._total += size - replaced
+        if self._total is None or self._total > self.max_bytes:
+            self._evict()
+
+    def clear(self):
+        for fname in self._entries():
+            self._remove(fname)
+        self._total = 0
+
+    def _entries(self):
+        return [os.path.join(self.path, f) for f in os.listdir(self.path)
+                if f.endswith('.pkl')]
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for fname in self._entries():
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, fname))
+            total += st.st_size
+        entries.sort()
+        if total > self.max_bytes:
+            # Make some room, so that the next stores do not each
+            # come straight back here.
+            while total > 0.9*self.max_bytes and entries:
+                mtime, size, fname = entries.pop(0)
+                self._remove(fname)
+                total -= size
+        self._total = total
+
+    @staticmethod
+    def _remove(fname):
+        try:
+            os.remove(fname)
+        except OSError:
+            pass
@@ -3,19 +3,78 @@ clean.py
 Author: Robert Buss
 """
 
+from collections import OrderedDict
+
+import numpy as np
 import pandas as pd
 
-def clean(raw):
+from stats import stats
+
+# Metadata that repeats on every row of a code.
+CATEGORY_COLUMNS = ['CCY', 'DISPNAME', 'FREQUENCY', 'SYMBOL']
+
+def clean(raw, fast=True, compact_dtypes=False, float32=False):
     """
     Turns RawData into a DataFrame.
 
     args:
     -----
     raw: RawData or list of RawData objects
-    
+
+    kwargs:
+    -------
+    fast: bool
+        Build the DataFrame in one go instead of making a DataFrame
+        for every code and concatenating them.  The result is the
+        same.  Anything the fast path does not handle (for example
+        series of different lengths for one code) quietly uses the
+        original method, so errors are also the same.
+    compact_dtypes: bool
+        Use less memory: the metadata (and any other text column)
+        become categoricals, the fields numbers and DATE datetime64.
+        Fields that are not numbers are kept as categoricals.
+    float32: bool
+        With compact_dtypes, store the fields as float32 instead of
+        float64.
+
     Returns:
     df: Pandas DataFrame
     """
+    with stats.span('clean'):
+        df = _clean(raw, fast)
+        if compact_dtypes:
+            df = _compact(df, float32)
+        return df
+
+def _compact(df, float32=False):
+    """
+    Smaller dtypes for the columns of a cleaned DataFrame.
+    """
+    for column in df.columns:
+        values = df[column]
+        if column == 'DATE':
+            df[column] = pd.to_datetime(values)
+        elif column in CATEGORY_COLUMNS:
+            df[column] = values.astype('category')
+        else:
+            if values.dtype == object:
+                try:
+                    values = pd.to_numeric(values)
+                except (ValueError, TypeError):
+                    # Text, e.g. a static field like NAME.
+                    df[column] = values.astype('category')
+                    continue
+            if values.dtype.kind in 'fiu':
+                values = values.astype(np.float32 if float32 else np.float64)
+            df[column] = values
+    return df
+
+def _clean(raw, fast):
+    if fast:
+        df = _fast_clean(raw)
+        if df is not None:
+            return df
+
     # Helper function
     def one_code_to_df(code_data):
         """
@@ -29,16 +88,159 @@ def clean(raw):
         return df
 
     if isinstance(raw, list):
-        """frames = [pd.concat([one_code_to_df(code_data) for code_data in 
+        """frames = [pd.concat([one_code_to_df(code_data) for code_data in
                     raw_piece.data]) for raw_piece in raw]"""
-        frames = [pd.concat([one_code_to_df(code_data) for code_data in 
-                    raw_piece.data]) for raw_piece in raw 
+        frames = [pd.concat([one_code_to_df(code_data) for code_data in
+                    raw_piece.data]) for raw_piece in raw
                     if raw_piece.data != None]
     else:
-        frames = [one_code_to_df(code_data) for code_data in raw.data 
+        frames = [one_code_to_df(code_data) for code_data in raw.data
                 if raw.data != None]
-        
+
     return pd.concat(frames)
 
+def _fast_clean(raw):
+    """
+    Fast path for clean().  Returns None when it cannot promise the
+    same result as the original method.
+    """
+    if isinstance(raw, list):
+        groups = [raw_piece.data for raw_piece in raw
+                if raw_piece.data != None]
+    else:
+        groups = [raw.data]
+    if len(groups) == 0 or any([not group for group in groups]):
+        # Let pd.concat raise the usual error.
+        return None
+
+    # Work out the length and column order of what would have been
+    # each code's DataFrame.
+    order_cache = {}
+    lengths = []
+    group_columns = []
+    for group in groups:
+        code_columns = []
+        for non_array_like, array_like in group:
+            n = None
+            for value in array_like.itervalues():
+                if isinstance(value, (list, tuple, np.ndarray)):
+                    if n is None:
+                        n = len(value)
+                    elif n != len(value):
+                        return None
+            if n is None:
+                if len(array_like) > 0:
+                    # All scalars, pandas needs an index.
+                    return None
+                # No data at all (e.g. INSTERROR), only metadata columns.
+                n = 0
+            lengths.append(n)
+
+            keys = tuple(array_like)
+            if keys not in order_cache:
+                # Let pandas decide the order, as it would have.
+                order_cache[keys] = list(pd.DataFrame(
+                    dict.fromkeys(keys, ())).columns)
+            columns = list(order_cache[keys])
+            for variable in non_array_like:
+                if variable not in array_like:
+                    columns.append(variable)
+            code_columns.append(columns)
+        group_columns.append(_concat_columns(code_columns))
+    columns = _concat_columns(group_columns)
+
+    if sum(lengths) == 0:
+        # The index of an all empty result is different.
+        return None
+
+    # Fill every column in one go.
+    codes = [code_data for group in groups for code_data in group]
+    # One Index object shared by every column, so that pandas does not
+    # try to align them.
+    index = pd.Index(np.concatenate([np.arange(n) for n in lengths]))
+    data = OrderedDict()
+    for column in columns:
+        pieces = []
+        for (non_array_like, array_like), n in zip(codes, lengths):
+            if column in non_array_like:
+                value = non_array_like[column]
+                # A column of None, not a missing one.
+                pieces.append([None]*n if value is None else value)
+            else:
+                pieces.append(array_like.get(column))
+        values = _fill_column(pieces, lengths)
+        if values is None:
+            return None
+        # Passing the dtype stops pandas from guessing again.
+        data[column] = pd.Series(values, index=index, dtype=values.dtype,
+                copy=False)
+
+    # Not passing columns: pandas would box every value to reorder them.
+    return pd.DataFrame(data, index=index)
+
+def _concat_columns(column_lists):
+    """
+    Column order that pd.concat gives for frames with these columns.
+    Only the distinct lists matter, so the frames are kept small.
+    """
+    distinct = []
+    for columns in column_lists:
+        if columns not in distinct:
+            distinct.append(columns)
+    if len(distinct) == 1:
+        return distinct[0]
+    return list(pd.concat([pd.DataFrame(columns=columns)
+        for columns in distinct]).columns)
+
+def _fill_column(pieces, lengths):
+    """
+    Joins the values of one column for every code.  A piece may be
+    None (the code lacks the column), a single value that is repeated,
+    or a sequence with one value per row.  Returns None when the dtype
+    of the original method cannot be worked out from the values alone.
+    """
+    total = sum(lengths)
+    arrays = [piece for piece in pieces if piece is not None]
+    dtypes = set([piece.dtype for piece in arrays
+        if isinstance(piece, np.ndarray)])
+    if (len(dtypes) == 1 and len(arrays) == sum([isinstance(piece, np.ndarray)
+            for piece in arrays])):
+        dtype = dtypes.pop()
+        if dtype == np.float64 or dtype == np.dtype('datetime64[ns]'):
+            # Arrays from compact RawData, nothing to infer.
+            values = np.empty(total, dtype=dtype)
+            start = 0
+            for piece, n in zip(pieces, lengths):
+                if piece is None:
+                    values[start:start+n] = np.nan if dtype == np.float64 \
+                            else np.datetime64('NaT')
+                else:
+                    values[start:start+n] = piece
+                start += n
+            return values
+
+    values = np.empty(total, dtype=object)
+    start = 0
+    for piece, n in zip(pieces, lengths):
+        if piece is None:
+            values[start:start+n] = np.nan
+        elif isinstance(piece, (list, tuple, np.ndarray)):
+            values[start:start+n] = list(piece)
+        else:
+            values[start:start+n] = [piece]*n
+        start += n
 
+    inferred = pd.Series(values).infer_objects().values
+    if inferred.dtype != object and any([_all_none(piece)
+            for piece in pieces]):
+        # Whether pd.concat keeps the dtype of the other pieces or
+        # makes the column object depends on what they are (floats
+        # stay, integers do not) and even on how each code's other
+        # columns are laid out, so only the original method knows.
+        return None
+    return inferred
 
+def _all_none(piece):
+    return (isinstance(piece, (list, tuple, np.ndarray)) and len(piece) > 0
+            and (not isinstance(piece, np.ndarray) or piece.dtype == object)
+            and all([v is None for v in piece]))
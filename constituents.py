@@ -0,0 +1,234 @@
+"""
+constituents.py
+
+Index membership through time.  Datastream keeps a constituent list
+for each index and month; Constituents fetches those lists in bulk
+and keeps them on disk as a small table of who was a member from
+when until when, so that point-in-time universes can be looked up
+without going back to Datastream.
+"""
+import os
+import warnings
+import tempfile
+
+import pandas as pd
+
+import utils
+from obtain import Obtain, RawData
+from sessions import SessionPool
+
+MEMBERSHIP_COLUMNS = ['index', 'code', 'start', 'end']
+
+def _intervals(index, snapshots):
+    """
+    Turns lists of members into membership intervals.
+
+    snapshots is a list of (date, set of codes), sorted by date.  A code
+    is a member from the first date it is listed up to, but not
+    including, the first later date it is missing from.  end is NaT
+    while it is still a member in the last list.
+    """
+    rows = []
+    since = {}
+    for date, members in snapshots:
+        for code in [c for c in since if c not in members]:
+            rows.append((index, code, since.pop(code), date))
+        for code in members:
+            if code not in since:
+                since[code] = date
+    rows.extend([(index, code, start, pd.NaT)
+        for code, start in since.items()])
+    rows.sort(key=lambda row: (row[2], row[1]))
+    return rows
+
+class Constituents(object):
+    def __init__(self, path, sessions=None, max_workers=4,
+            id_field='DSCD', governor=None):
+        """
+        Index constituents stored in the directory path.
+
+        The directory holds two csv files: membership.csv, with one
+        row per (index, code, start, end) interval, and snapshots.csv,
+        with the (index, date) lists that have been fetched.
+
+        Parameters:
+        -----------
+        path: str
+        sessions: SessionPool (optional)
+            Where the Obtain sessions come from.  By default a pool of
+            max_workers sessions is made.
+        max_workers: int
+            Lists fetched at the same time.
+        id_field: str
+            Datastream field used as the code of each member.  DSCD
+            (the Datastream code) also works for dead companies.
+        governor: Governor (optional)
+            Paces and retries the requests of the sessions made here.
+            Ignored when sessions is given.
+        """
+        self.path = os.path.expanduser(path)
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        if sessions is None:
+            sessions = SessionPool(size=max_workers,
+                    factory=lambda: Obtain(governor=governor))
+        self.sessions = sessions
+        self.max_workers = max_workers
+        self.id_field = id_field
+        self._load()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _load(self):
+        try:
+            self.membership = pd.read_csv(self._file('membership.csv'),
+                    parse_dates=['start', 'end'], dtype={'code': object})
+        except IOError:
+            self.membership = pd.DataFrame(columns=MEMBERSHIP_COLUMNS)
+        try:
+            self.snapshots = pd.read_csv(self._file('snapshots.csv'),
+                    parse_dates=['date'])
+        except IOError:
+            self.snapshots = pd.DataFrame(columns=['index', 'date'])
+
+    def _save(self):
+        for name, df in [('membership.csv', self.membership),
+                ('snapshots.csv', self.snapshots)]:
+            # Write to a temporary file and rename it into place so that
+            # a crash never leaves half a table.
+            fd, tmp = tempfile.mkstemp(dir=self.path, suffix='.tmp')
+            os.close(fd)
+            df.to_csv(tmp, index=False, encoding='utf-8')
+            os.rename(tmp, self._file(name))
+
+    def dates(self, index):
+        """ Sorted dates of the lists of index that are stored. """
+        dates = self.snapshots.date[self.snapshots['index'] == index]
+        return sorted(pd.to_datetime(dates))
+
+    def _fetch_list(self, o, index, date):
+        """
+        Members of index in the month of date, or None if Datastream
+        has no list for it.
+        """
+        query = Obtain._construct_request(
+                'L' + index + date.strftime('%m%y'),
+                fields=[self.id_field], freq='REP')
+        raw = list(o.request(query))
+        if raw[2][1] != 'Connected':
+            return None
+        fields = dict([RawData._parseField(field)
+            for field in raw[5][1][0]])
+        if any([name.startswith('INSTERROR') for name in fields]):
+            return None
+        # The members come back as ID, ID_2, ID_3, ...
+        return set([value for name, value in fields.items()
+            if name.split('_')[0] == self.id_field and value])
+
+    def update(self, index, start, end=None, freq='MS'):
+        """
+        Fetches the lists of index for the dates from start to end
+        that are not stored yet, and stores them.
+
+        Parameters:
+        -----------
+        index: str
+            Datastream code of the index, e.g. 'S&PCOMP'.
+        start, end: date or str
+            end defaults to today.
+        freq: str
+            pandas frequency of the dates.  Datastream keeps one list
+            a month, so anything finer fetches the same list again.
+
+        Returns:
+        --------
+        missing: list of dates for which Datastream had no list
+            These are tried again by the next update.
+        """
+        if end is None:
+            end = pd.Timestamp.today()
+        wanted = pd.date_range(start, end, freq=freq)
+        have = set(self.dates(index))
+        todo = [date for date in wanted if date not in have]
+        if not todo:
+            return []
+
+        def fetch_one(date):
+            with self.sessions.session() as o:
+                return date, self._fetch_list(o, index, date)
+
+        lists = list(utils.map_chunks(fetch_one, todo,
+            max_workers=self.max_workers))
+        missing = [date for date, members in lists if members is None]
+        found = [(date, members) for date, members in lists
+                if members is not None]
+        if missing:
+            warnings.warn("No constituents of {} for {} dates.".format(
+                index, len(missing)))
+        if found:
+            self._store(index, found)
+        return missing
+
+    def _store(self, index, found):
+        """ Adds lists (date, set of codes) of index to the tables. """
+        dates = self.dates(index)
+        # The stored intervals give back every stored list.
+        snapshots = [(date, set(self.members(index, date)))
+                for date in dates] + found
+        snapshots.sort(key=lambda pair: pair[0])
+
+        others = self.membership[self.membership['index'] != index]
+        rows = pd.DataFrame(_intervals(index, snapshots),
+                columns=MEMBERSHIP_COLUMNS)
+        new = pd.DataFrame([(index, date) for date, members in found],
+                columns=['index', 'date'])
+        # Leave out empty tables, which would make the dates objects.
+        self.membership = pd.concat([df for df in [others, rows]
+            if len(df) > 0], ignore_index=True)
+        self.snapshots = pd.concat([df for df in [self.snapshots, new]
+            if len(df) > 0], ignore_index=True)
+        self._save()
+
+    def members(self, index, date):
+        """
+        Codes that were members of index on date, from the stored
+        lists.  Dates after the last list get that list.
+        """
+        date = pd.Timestamp(date)
+        dates = self.dates(index)
+        if not dates or date < dates[0]:
+            warnings.warn("No constituents of {} stored for {}.".format(
+                index, date.date()))
+        m = self.membership
+        valid = ((m['index'] == index) & (m.start <= date)
+                & (m.end.isnull() | (m.end > date)))
+        return sorted(m.code[valid])
+
+    def universe(self, index, start=None, end=None):
+        """
+        Every code that was a member of index at some time between
+        start and end (default: all stored dates), e.g. to fetch
+        without survivorship bias.
+        """
+        m = self.membership[self.membership['index'] == index]
+        if start is not None:
+            m = m[m.end.isnull() | (m.end > pd.Timestamp(start))]
+        if end is not None:
+            m = m[m.start <= pd.Timestamp(end)]
+        return sorted(set(m.code))
+
+    def fetch(self, index, start, end=None, out_dir=None, n=16, **kwargs):
+        """
+        Fetches data for the universe of index between start and end,
+        updating the stored lists first.
+
+        With out_dir the data goes through utils.robust_fetch (and
+        kwargs to it), otherwise through utils.fetch.
+        """
+        self.update(index, start, end)
+        codes = self.universe(index, start, end)
+        if out_dir is not None:
+            return utils.robust_fetch(codes, out_dir, **kwargs)
+        return utils.fetch(codes, n, max_workers=self.max_workers,
+                sessions=self.sessions, **kwargs)
@@ -0,0 +1,131 @@
+"""
+governor.py
+
+Paces requests to Datastream so that many workers together stay under
+the server's limits: a token bucket for the request rate, retries
+with backoff for transient errors, and a circuit breaker that stops
+everyone for a while when the service keeps failing.
+"""
+import time
+import random
+import httplib
+import threading
+import warnings
+
+from stats import stats
+
+try:
+    from suds.transport import TransportError
+    TRANSIENT = (IOError, httplib.HTTPException, TransportError)
+except ImportError:
+    TRANSIENT = (IOError, httplib.HTTPException)
+
+def response_status(response):
+    """ StatusType of a Datastream response, or None if it has none. """
+    try:
+        return dict(response).get('StatusType')
+    except (TypeError, ValueError):
+        return None
+
+class Governor(object):
+    def __init__(self, rate=10., burst=10, retries=3, backoff=1.,
+            max_backoff=60., failure_threshold=5, cooldown=60.,
+            transient=TRANSIENT):
+        """
+        Share one Governor between all the sessions of a job.
+
+        Parameters:
+        -----------
+        rate: float
+            Requests per second allowed on average.
+        burst: int
+            Requests that can be made at once after a quiet spell.
+        retries: int
+            Times a request is tried again after a transient error.
+        backoff: float
+            Seconds to wait before the first retry.  The wait doubles
+            with every retry, up to max_backoff, and is jittered.
+        max_backoff: float
+        failure_threshold: int
+            Connection failures in a row (errors, or responses whose
+            StatusType is not 'Connected') that open the circuit.
+        cooldown: float
+            Seconds that every request waits once the circuit is open.
+        transient: tuple of exception classes
+            Errors worth retrying.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.transient = transient
+
+        self.retry_count = 0
+        self._lock = threading.Lock()
+        self._tokens = float(burst)
+        self._last = time.time()
+        self._failures = 0
+        self._open_until = 0.
+
+    def _wait_for_token(self):
+        while True:
+            with self._lock:
+                now = time.time()
+                self._tokens = min(self.burst,
+                        self._tokens + (now-self._last)*self.rate)
+                self._last = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1-self._tokens)/self.rate
+            time.sleep(wait)
+
+    def _wait_for_circuit(self):
+        while True:
+            wait = self._open_until - time.time()
+            if wait <= 0:
+                return
+            time.sleep(wait)
+
+    def _record(self, ok):
+        with self._lock:
+            if ok:
+                self._failures = 0
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                self._failures = 0
+                self._open_until = time.time() + self.cooldown
+                warnings.warn("Datastream keeps failing; pausing requests "
+                        "for {} seconds.".format(self.cooldown))
+
+    def call(self, func, *args, **kwargs):
+        """
+        Calls func(*args, **kwargs), a request to Datastream, within
+        the limits.
+        """
+        attempt = 0
+        while True:
+            self._wait_for_circuit()
+            self._wait_for_token()
+            try:
+                response = func(*args, **kwargs)
+            except self.transient:
+                self._record(False)
+                if attempt >= self.retries:
+                    raise
+            else:
+                status = response_status(response)
+                self._record(status is None or status == 'Connected')
+                return response
+
+            delay = min(self.max_backoff, self.backoff*2**attempt)
+            attempt += 1
+            with self._lock:
+                self.retry_count += 1
+            stats.count('retries')
+            # Full jitter, so that workers do not retry in step.
+            time.sleep(random.uniform(0, delay))
@@ -0,0 +1,65 @@
+"""
+journal.py
+
+An append-only record of which codes a long download has finished,
+so that it can pick up where it left off after a crash.
+"""
+import os
+
+class Journal(object):
+    def __init__(self, path):
+        """
+        Keeps a log with one line per code, 'done<TAB>code' or
+        'failed<TAB>code'.  Lines are flushed to disk as they are
+        written.  If a code appears more than once the last line wins.
+
+        Parameters:
+        -----------
+        path: str
+        """
+        self.path = os.path.expanduser(path)
+        self._file = None
+
+    def read(self):
+        """
+        Returns the sets (done, failed) from the log.
+        """
+        status = {}
+        try:
+            with open(self.path) as f:
+                for line in f:
+                    try:
+                        state, code = line.rstrip('\n').split('\t', 1)
+                    except ValueError:
+                        # A line cut short by a crash.
+                        continue
+                    status[code.decode('utf-8')] = state
+        except IOError:
+            pass
+        done = set([c for c, state in status.items() if state == 'done'])
+        failed = set([c for c, state in status.items() if state == 'failed'])
+        return done, failed
+
+    def clear(self):
+        self.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def _write(self, state, codes):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        for code in codes:
+            self._file.write(u"{}\t{}\n".format(state, code).encode('utf-8'))
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def done(self, codes):
+        self._write('done', codes)
+
+    def failed(self, codes):
+        self._write('failed', codes)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
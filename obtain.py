@@ -8,53 +8,222 @@ See LICENSE.txt
 import re
 import sys
 import warnings
+import threading
 import datetime as dt
 from netrc import netrc
 
+import numpy as np
 import pandas as pd
 
 from pydatastream import Datastream
 
-class Obtain(Datastream):
+import planner
+from cache import to_plain
+from clean import clean
+from sinks import BufferedWriter
+from stats import stats
+
+# Static values already fetched by any Obtain in this process,
+# keyed like Obtain.fetch_static's cache entries.
+_static_memo = {}
+
+# State of the first session made with each login, so that later
+# sessions need not download and parse the WSDL again.
+_connections = {}
+_connections_lock = threading.Lock()
+
+# Requests being sent right now by any session in the process.
+_flights = {}
+_flights_lock = threading.Lock()
+
+class _Flight(object):
     def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+
+def single_flight(query, func, *args, **kwargs):
+    """
+    Returns func(*args, **kwargs), the response to the request string
+    query, unless the same request is already being sent somewhere
+    else in the process.  Then it waits for that one and returns (or
+    raises) what it does, instead of sending the request again.
+    """
+    with _flights_lock:
+        flight = _flights.get(query)
+        first = flight is None
+        if first:
+            flight = _flights[query] = _Flight()
+
+    if not first:
+        stats.count('coalesced', request=query)
+        # With a timeout, so that Ctrl-C gets through.
+        while not flight.done.wait(1.):
+            pass
+        if flight.error is not None:
+            raise flight.error[0], flight.error[1], flight.error[2]
+        return flight.response
+
+    try:
+        flight.response = func(*args, **kwargs)
+    except Exception:
+        flight.error = sys.exc_info()
+        raise
+    finally:
+        with _flights_lock:
+            del _flights[query]
+        flight.done.set()
+    return flight.response
+
+def connect(session, username, password):
+    """
+    Sets up session (a Datastream) like Datastream.__init__ does.
+
+    Only the first session with a login in the process really
+    connects.  The others copy its state and get a clone of its suds
+    client, which shares the parsed service description but nothing
+    else, so sessions can still be used from different threads.
+    (suds also keeps the parsed WSDL on disk for a day, which helps
+    the first session of a new process.)
+    """
+    key = (username, password)
+    with _connections_lock:
+        state = _connections.get(key)
+        if state is None:
+            Datastream.__init__(session, username=username,
+                    password=password)
+            _connections[key] = dict(session.__dict__)
+            return
+    session.__dict__.update(state)
+    session.client = state['client'].clone()
+
+class Obtain(Datastream):
+    def __init__(self, cache=None, governor=None):
         """
         Obtain is used to obtain data from Thomson Reuter's
         Datastream (More specifically, from DataWorks Enterprise).
         
         Obtain interfaces the pydatastream package.
+
+        Parameters:
+        -----------
+        cache: ResponseCache (optional)
+            When given, responses are looked up in (and saved to) the
+            cache before going to Datastream.
+        governor: Governor (optional)
+            Paces and retries the requests that go to Datastream.
+            Share one between all the sessions of a job.
         """
         # Reads in credentials from the user's .netrc file
         rc = netrc()
         uname, account, passwd = rc.authenticators('datastream')
         # Now we are ready to set everything else.
-        Datastream.__init__(self, username=uname, password=passwd)
+        connect(self, uname, passwd)
+        self.cache = cache
+        self.governor = governor
 
-    def from_csv(self, path, date_col=1, **kwargs):
+    def request(self, query, *args, **kwargs):
+        """
+        Same as Datastream.request(), but checks self.cache first.
+        Only plain requests (no extra arguments) are cached, since
+        the cache is keyed on the request string alone.  For the same
+        reason only they share the response with an identical request
+        that is already on its way (see single_flight).
+        """
+        if args or kwargs:
+            return self._send(query, *args, **kwargs)
+        cache = getattr(self, 'cache', None)
+        if cache is None:
+            return single_flight(query, self._send, query)
+        raw = cache.get(query)
+        if raw is None:
+            stats.count('cache_miss')
+            raw = single_flight(query,
+                    lambda: cache.put(query, self._send(query)))
+        else:
+            stats.count('cache_hit')
+        return raw
+
+    def _send(self, query, *args, **kwargs):
+        """ Makes the request, through self.governor if there is one. """
+        governor = getattr(self, 'governor', None)
+        with stats.span('network', request=query):
+            if governor is None:
+                response = Datastream.request(self, query, *args, **kwargs)
+            else:
+                response = governor.call(Datastream.request, self, query, 
+                        *args, **kwargs)
+        stats.count('requests', request=query)
+        if stats.measure_bytes:
+            try:
+                stats.count('bytes', len(str(self.client.last_received())),
+                        request=query)
+            except Exception:
+                pass
+        return response
+
+    def from_csv(self, path, date_col=1, sink=None, max_memory=256*1024**2,
+            max_spread=365, **kwargs):
         """
         This loads the Excel file (saved as a csv) that you can download
         from Datastream's Datastream navigator.  The download button is located
         in the upper right corner of the popup window when you are searching 
         for series.  
 
+        Codes are requested in batches of up to 16 codes with similar
+        start dates (see planner.plan_requests), and each batch starts
+        at the earliest start date among its codes rather than the
+        earliest in the file.
+
+        Parameters:
+        -----------
+        path: str
+        date_col: int
+        sink: CSVSink, ParquetSink, CallbackSink (optional)
+            When given, each chunk is cleaned and written to sink as
+            it arrives, and sink is returned instead of the RawData.
+        max_memory: int (optional)
+            Bytes of cleaned data to hold before writing to sink.
+        max_spread: int (optional)
+            Most days between start dates of codes in one request.
+            Use None to request everything from the earliest date,
+            as older versions did.
+
         Returns:
         --------
-        raw: RawData, or list of RawData
+        raw: RawData if there is only one batch, else a list of RawData
         """
         df = pd.read_csv(path, usecols=['Symbol', 'Start Date'],
                 parse_dates=[date_col])
         df.columns = ['code', 'start_date']
-        start_date = min(df.start_date)
-        codes = df.code.tolist()
-        if len(codes) <= 16:
-            return self.fetch(codes, start_date=start_date, **kwargs)
+        if max_spread is None:
+            start_date = min(df.start_date)
+            codes = df.code.tolist()
+            batches = [(codes[i:i+16], start_date) for i in 
+                    xrange(0, len(codes), 16)]
         else:
-            # Split up the codes into chunks of about 16 codes each.
-            def codes_split():
-                for i in xrange(0, len(codes), 16):
-                    yield codes[i:i+16]
-
-            return [self.fetch(code_seg, start_date=start_date, **kwargs) for
-                        code_seg in codes_split()]
+            batches = planner.plan_requests(zip(df.code, df.start_date),
+                    max_spread=max_spread)
+
+        if sink is not None:
+            writer = BufferedWriter(sink, max_memory=max_memory)
+            try:
+                for code_seg, start_date in batches:
+                    raw = self.fetch(code_seg, start_date=start_date, **kwargs)
+                    if raw.data is None:
+                        warnings.warn("Unable to load {}: {}".format(
+                            code_seg, raw.StatusMessage))
+                        continue
+                    writer.write(clean(raw))
+            finally:
+                writer.close()
+            return sink
+
+        raw = [self.fetch(code_seg, start_date=start_date, **kwargs) for 
+                code_seg, start_date in batches]
+        if len(raw) == 1:
+            return raw[0]
+        return raw
 
 
     def constituents(self, code, date):
@@ -62,7 +231,7 @@ class Obtain(Datastream):
         pass
 
     def fetch(self, codes, fields=None, static_fields=None, freq='D',
-            start_date=None, n_years=None, n_days=None):
+            start_date=None, n_years=None, n_days=None, compact=False):
         """
         Fetches data from Datastream.
 
@@ -89,7 +258,9 @@ class Obtain(Datastream):
             The full list of data fields is available at http://dtg.tfn.com/.
 
         static_fields: str or list
-            Datastream codes for static variables.  This feature is fragile.
+            Datastream codes for static variables.  They are fetched
+            with fetch_static() (and so cached) and added to each
+            code's metadata.
 
         feq: 'D', 'W', 'M', or 'REP'
             Frequency of the data.  Datastream has three frequencies 
@@ -112,44 +283,134 @@ class Obtain(Datastream):
         n_days: int
             Number of years ago the series should start
 
+        compact: bool
+            Store the series as NumPy arrays.  See RawData.
+
         Returns
         -------
         raw: RawData
         """
-        query = self._construct_request(codes, 
-                fields=fields, 
-                start_date=start_date, n_years=n_years, n_days=n_days, 
-                freq=freq)
-        raw = list(self.request(query))
+        raw = self.fetch_raw(codes, fields=fields, freq=freq,
+                start_date=start_date, n_years=n_years, n_days=n_days)
+        static = None
+        if static_fields is not None:
+            static = self.fetch_static(codes, static_fields)
+        return parse(raw, static=static, compact=compact)
+
+    def fetch_raw(self, codes, fields=None, freq='D', start_date=None,
+            n_years=None, n_days=None, plain=False):
+        """
+        The network half of fetch(): makes the request and returns
+        the response as a list, with codes added at the end, ready
+        for RawData (see parse()).
+
+        plain: bool
+            Turn the response into Records, which can be pickled, e.g.
+            to be parsed in another process.
+        """
+        with stats.span('build'):
+            query = self._construct_request(codes, 
+                    fields=fields, 
+                    start_date=start_date, n_years=n_years, n_days=n_days, 
+                    freq=freq)
+        raw = self.request(query)
+        if plain:
+            raw = to_plain(raw)
+        raw = list(raw)
         raw.append(codes)
-        rawdata = RawData(raw)
+        return raw
 
-        if static_fields is not None:
-            static_query = self._construct_request(codes, 
-                    fields=static_fields, 
+    def fetch_static(self, codes, static_fields):
+        """
+        Fetches static ('REP') fields for any number of codes.
+
+        Values are remembered for the life of the process (and kept in
+        self.cache, if there is one), so asking for the same codes
+        and fields again does not go to Datastream.  Codes that are
+        not known yet are requested 16 at a time.  Problems give a
+        warning; the codes involved are left out of the result.
+
+        Parameters:
+        -----------
+        codes: str or list
+        static_fields: str or list
+
+        Returns:
+        --------
+        static: dict
+            {code: {field: value}}
+        """
+        if isinstance(codes, basestring):
+            codes = [codes]
+        if isinstance(static_fields, basestring):
+            static_fields = [static_fields]
+
+        def key(code):
+            return u'static:{}~={}~REP'.format(code, ','.join(static_fields))
+
+        static = {}
+        missing = []
+        for code in codes:
+            values = _static_memo.get(key(code))
+            if values is None and getattr(self, 'cache', None) is not None:
+                values = self.cache.get(key(code))
+            if values is None:
+                missing.append(code)
+            else:
+                static[code] = values
+
+        batches = [list(missing[i:i+16]) for i in
+                xrange(0, len(missing), 16)]
+        while batches:
+            batch = batches.pop(0)
+            query = self._construct_request(batch, fields=static_fields, 
                     freq="REP")
-            static_raw = list(self.request(static_query))
-            static_raw.append(codes)
-            # static_data = RawData(static_raw).data[0][1]
-            static_data = RawData(static_raw).data
-            # We only need the data from the static_fields
-            if static_data != None:
-                try:
-                    # I think that this first line is the only 
-                    # line that might have problems.
-                    static_data = [item[1] for item in static_data]
-                    for item in static_data: del item["DATE"]
-
-                    # now we merge this into rawdata.
-                    for idx in range(len(static_data)):
-                        rawdata.data[idx][0].update(static_data[idx])
-                except:
-                    print "ERROR", sys.exc_info()[0]
-                    warnings.warn("Error in processing static codes.")
-                    raw_input()
-
-        return rawdata
+            raw = list(self.request(query))
+            raw.append(batch)
+            try:
+                rawdata = RawData(raw)
+            except TypeError:
+                # One code's response cannot be read.  Try the halves
+                # until it is alone, and leave it out.
+                if len(batch) > 1:
+                    half = len(batch)//2
+                    batches[:0] = [batch[:half], batch[half:]]
+                else:
+                    warnings.warn("Unable to load static fields for "
+                            "{}".format(batch))
+                continue
+            if rawdata.data is None:
+                warnings.warn("Unable to load static fields for {}: {}".format(
+                    batch, rawdata.StatusMessage))
+                continue
+            unknown = []
+            for code, (non_array, array_data) in zip(batch, rawdata.data):
+                values = dict([(k, v) for k, v in array_data.items() 
+                    if k != 'DATE'])
+                if not any([field in values for field in static_fields]):
+                    # INSTERROR, which may be a typo or a passing
+                    # problem.  Nothing is remembered, so the code is
+                    # asked for again next time.
+                    unknown.append(code)
+                    continue
+                static[code] = values
+                _static_memo[key(code)] = values
+                if getattr(self, 'cache', None) is not None:
+                    self.cache.store(key(code), values)
+            if unknown:
+                warnings.warn("No static fields for {}".format(unknown))
+        return static
 
+    @staticmethod
+    def merge_static(rawdata, static):
+        """
+        Adds static values (from fetch_static) to the metadata of each
+        code in rawdata, matching on SYMBOL.
+        """
+        if rawdata.data is None:
+            return
+        for non_array, array_data in rawdata.data:
+            non_array.update(static.get(non_array['SYMBOL'], {}))
 
     @staticmethod
     def _construct_request(codes, fields=None, freq=None,
@@ -233,8 +494,31 @@ class Obtain(Datastream):
 
         return request
 
+def parse(raw, static=None, compact=False):
+    """
+    The parsing half of Obtain.fetch(): makes RawData from a response
+    given by Obtain.fetch_raw() and adds the static values (from
+    Obtain.fetch_static()) to each code's metadata.
+    """
+    with stats.span('parse', request=raw[1][1]):
+        rawdata = RawData(raw, compact=compact)
+    if rawdata.data is not None:
+        # The dates are not data points of their own.
+        stats.count('points', sum([len(v) for non_array, array_data in 
+            rawdata.data for k, v in array_data.iteritems() 
+            if k != 'DATE' and isinstance(v, (list, np.ndarray))]),
+            request=raw[1][1])
+    if static is not None:
+        Obtain.merge_static(rawdata, static)
+    return rawdata
+
 class RawData(object):
-    def __init__(self, raw):
+    # Fields that are metadata, not series.  Matched as substrings
+    # to be consistent with the suffixed names (CCY_2, DATE_3, ...).
+    non_array_fields = ['CCY', 'DISPNAME', 'FREQUENCY', 'SYMBOL', 
+            'DATE', 'INSTERROR']
+
+    def __init__(self, raw, compact=False):
         """
         Takes raw data and makes it nice.
 
@@ -244,9 +528,18 @@ class RawData(object):
         You can find out more about what went wrong by looking
         at RawData.StatusMessage.
 
+        In compact mode the series are stored as NumPy arrays
+        instead of lists.  For each code the numeric fields share
+        one float64 block (RawData.blocks) and RawData.data holds
+        views of its rows, along with the dates as datetime64.
+
         args:
         -----
         Raw data that comes from Obtain
+
+        kwargs:
+        -------
+        compact: bool
         """
         # Break raw into it's constituent pieces.
         self.Instrument    = raw[1][1]
@@ -255,12 +548,14 @@ class RawData(object):
         self.StatusMessage = raw[4][1]
         self.Fields        = raw[5]
         self.Codes         = raw[6]
-
+        self.compact       = compact
 
         # Check to see if status code is acceptable
         if self.StatusType != 'Connected':
             self.data = None
             # raise Exception('Not connected.') # WARNING
+        elif compact:
+            self._build_compact(self.Fields[1][0])
         else:
             Fields = self.Fields[1][0]
             field_dict = dict([self._parseField(field) for field in Fields])
@@ -310,6 +605,95 @@ class RawData(object):
 
                 self.data.append([non_array, array_data])
 
+    def _build_compact(self, Fields):
+        """
+        Builds self.data and self.blocks with a single pass over
+        the fields.
+        """
+        # Index every field by the position of its code.  Unsuffixed
+        # fields belong to the first code, FIELD_k to the k-th.
+        by_code = {}
+        for field in Fields:
+            name, contents = self._parseField(field)
+            base, sep, k = name.rpartition('_')
+            if sep and k.isdigit():
+                by_code.setdefault(int(k)-1, {})[base] = contents
+            else:
+                by_code.setdefault(0, {})[name] = contents
+
+        shared_date = by_code.get(0, {}).get('DATE')
+        is_array = {}
+        # Codes often share one DATE list; convert each list once.
+        converted = {}
+
+        self.data = []
+        self.blocks = []
+        for k in range(len(self.Codes)):
+            fields = by_code.get(k, {})
+
+            non_array = dict()
+            non_array['SYMBOL'] = unicode(self.Codes[k])
+            for key in [u'CCY', u'DISPNAME', u'FREQUENCY']:
+                if key in fields:
+                    non_array[key] = fields[key]
+
+            date = fields.get('DATE', shared_date)
+            if date is not None:
+                if id(date) not in converted:
+                    converted[id(date)] = self._to_array(date, 
+                            'datetime64[ns]')
+                date = converted[id(date)]
+
+            names = []
+            rows = []
+            array_data = {}
+            for name in sorted(fields):
+                if name not in is_array:
+                    is_array[name] = not any(
+                            [y in name for y in self.non_array_fields])
+                if not is_array[name]:
+                    continue
+                if isinstance(fields[name], basestring):
+                    # Single values are broadcast by clean(), as before.
+                    array_data[name] = fields[name]
+                    continue
+                values = self._to_array(fields[name], np.float64)
+                if values.dtype == np.float64:
+                    names.append(name)
+                    rows.append(values)
+                else:
+                    # Text series stay as object arrays.
+                    array_data[name] = values
+
+            if len(set(len(row) for row in rows)) <= 1:
+                # One contiguous block per code; each field is a row view.
+                block = np.array(rows, dtype=np.float64, ndmin=2)
+                for i, name in enumerate(names):
+                    array_data[name] = block[i]
+            else:
+                block = None
+                for name, values in zip(names, rows):
+                    array_data[name] = values
+            if date is not None:
+                array_data['DATE'] = date
+
+            self.blocks.append((date, tuple(names), block))
+            self.data.append([non_array, array_data])
+
+    @staticmethod
+    def _to_array(contents, dtype):
+        """
+        Converts the contents of an ArrayValue to a NumPy array of
+        dtype, or an object array if that is not possible.
+        """
+        try:
+            if dtype == 'datetime64[ns]':
+                # Much faster than NumPy for lists of datetime objects.
+                return pd.to_datetime(contents).values
+            return np.asarray(contents, dtype=dtype)
+        except (TypeError, ValueError):
+            return np.asarray(contents, dtype=object)
+
     def __repr__(self):
         return "Obtain RawData for {}.".format(self.Instrument)
 
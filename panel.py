@@ -0,0 +1,206 @@
+"""
+panel.py
+
+Wide panels: one column per code and field, one row per date.  They
+can be kept on disk in a PanelStore and memory-mapped back.
+"""
+import os
+import re
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from stats import stats
+
+def _date_axis(indexes):
+    """
+    The union of the indexes, sorted, as pd.concat(axis=1) gives it.
+    Returns the first index as it is when they are all the same.
+    """
+    first = indexes[0]
+    if all([index.equals(first) for index in indexes[1:]]):
+        return first
+    values = np.unique(np.concatenate([index.values for index in indexes]))
+    names = set([index.name for index in indexes])
+    return pd.Index(values, name=names.pop() if len(names) == 1 else None)
+
+def build_panel(frames, multiindex=False):
+    """
+    Puts the DataFrames of many codes side by side.
+
+    The same as pd.concat of the frames with axis=1, but the union of
+    the dates is worked out once and every series is copied straight
+    into its place in one preallocated float array.
+
+    Parameters:
+    -----------
+    frames: list of (code, DataFrame) pairs
+        Each DataFrame has dates as the index and fields as columns,
+        as pydatastream's fetch gives them.  None is skipped.
+    multiindex: bool
+        Label the columns with a MultiIndex of (code, field) instead
+        of "CODE(FIELD)" strings.
+
+    Returns:
+    --------
+    panel: DataFrame
+        Float columns.  If a frame has a column that is not a number
+        or has the same date twice, the frames are joined with
+        pd.concat instead.
+    """
+    frames = [(code, df) for code, df in frames if df is not None]
+    if multiindex:
+        labels = [(code, field) for code, df in frames for field in df.columns]
+        columns = pd.MultiIndex.from_tuples(labels, names=['code', 'field'])
+    else:
+        columns = [code + "({})".format(field)
+                for code, df in frames for field in df.columns]
+    if len(frames) == 0:
+        # Let pd.concat raise the usual error.
+        return pd.concat([])
+
+    with stats.span('panel', codes=len(frames)):
+        numeric = all([dtype.kind in 'fi' for code, df in frames
+            for dtype in df.dtypes])
+        unique = all([df.index.is_unique for code, df in frames])
+        if not (numeric and unique):
+            panel = pd.concat([df for code, df in frames], axis=1)
+            panel.columns = columns
+            return panel
+
+        index = _date_axis([df.index for code, df in frames])
+        block = np.empty((len(index), len(columns)), dtype=np.float64)
+        block.fill(np.nan)
+        start = 0
+        for code, df in frames:
+            width = len(df.columns)
+            if df.index is index or df.index.equals(index):
+                block[:, start:start+width] = df.values
+            else:
+                block[index.get_indexer(df.index), start:start+width] = \
+                        df.values
+            start += width
+        return pd.DataFrame(block, index=index, columns=columns)
+
+def long_to_panel(df, fields=None, code_col='SYMBOL', date_col='DATE'):
+    """
+    Wide panel, with (code, field) columns, from the long DataFrame
+    that clean() gives.  fields defaults to every numeric column.
+    """
+    if fields is None:
+        fields = [column for column in df.columns
+                if column not in (code_col, date_col)
+                and df[column].dtype.kind in 'fi']
+    frames = [(code, group.set_index(date_col)[fields])
+            for code, group in df.groupby(code_col, sort=False)]
+    return build_panel(frames, multiindex=True)
+
+def _split_columns(columns):
+    """ (code, field) pairs from MultiIndex or "CODE(FIELD)" columns. """
+    if isinstance(columns, pd.MultiIndex):
+        return list(columns)
+    pairs = []
+    for column in columns:
+        match = re.match(r'^(.*)\((.*)\)$', column)
+        if match is None:
+            raise ValueError("Column {} is not CODE(FIELD).".format(column))
+        pairs.append(match.groups())
+    return pairs
+
+class PanelStore(object):
+    def __init__(self, path):
+        """
+        Opens a panel saved with PanelStore.write().  The values are
+        memory-mapped read-only, so opening is instant and any number
+        of processes share the same pages.
+
+        The directory holds dates.npy (the shared date axis),
+        columns.csv (the code and field of each series) and
+        block.npy, a float64 array with one row per series.
+        """
+        self.path = os.path.expanduser(path)
+        self.dates = pd.DatetimeIndex(np.load(os.path.join(self.path,
+            'dates.npy')))
+        columns = pd.read_csv(os.path.join(self.path, 'columns.csv'),
+                dtype=object)
+        self.columns = pd.MultiIndex.from_arrays([columns.code,
+            columns.field], names=['code', 'field'])
+        self.block = np.load(os.path.join(self.path, 'block.npy'),
+                mmap_mode='r')
+        self._position = dict(zip(self.columns, xrange(len(self.columns))))
+
+    @classmethod
+    def write(cls, path, data, fields=None):
+        """
+        Saves data and returns the opened store.
+
+        Parameters:
+        -----------
+        path: str
+            Directory for the store.  An existing store is replaced.
+        data: DataFrame
+            Either the long output of clean() (with DATE and SYMBOL
+            columns; see long_to_panel for fields) or a wide panel
+            like streamer.content, with MultiIndex (code, field) or
+            "CODE(FIELD)" columns.
+        """
+        path = os.path.expanduser(path)
+        if 'DATE' in data.columns and 'SYMBOL' in data.columns:
+            data = long_to_panel(data, fields)
+        pairs = _split_columns(data.columns)
+
+        # Write next to the store and swap it in at the end, so that
+        # readers never see half a store.
+        parent = os.path.dirname(os.path.abspath(path))
+        tmp = tempfile.mkdtemp(dir=parent, suffix='.tmp')
+        np.save(os.path.join(tmp, 'dates.npy'),
+                pd.DatetimeIndex(data.index).values)
+        pd.DataFrame(pairs, columns=['code', 'field']).to_csv(
+                os.path.join(tmp, 'columns.csv'), index=False,
+                encoding='utf-8')
+        block = np.lib.format.open_memmap(os.path.join(tmp, 'block.npy'),
+                mode='w+', dtype=np.float64,
+                shape=(len(pairs), len(data.index)))
+        for k in xrange(len(pairs)):
+            block[k] = data.iloc[:, k].values
+        block.flush()
+        del block
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.rename(tmp, path)
+        return cls(path)
+
+    def codes(self):
+        return list(self.columns.levels[0])
+
+    def fields(self):
+        return list(self.columns.levels[1])
+
+    def series(self, code, field):
+        """ The values of one series, without copying. """
+        return self.block[self._position[(code, field)]]
+
+    def get(self, codes=None, fields=None, start=None, end=None):
+        """
+        DataFrame of the series of codes and fields (default: all)
+        between the dates start and end.  When the series asked for
+        are next to each other in the store, nothing is copied.
+        """
+        rows = slice(None if start is None else
+                self.dates.searchsorted(pd.Timestamp(start), 'left'),
+                None if end is None else
+                self.dates.searchsorted(pd.Timestamp(end), 'right'))
+        positions = [k for k, (code, field) in enumerate(self.columns)
+                if (codes is None or code in codes)
+                and (fields is None or field in fields)]
+        if positions and positions == range(positions[0],
+                positions[-1] + 1):
+            values = self.block[positions[0]:positions[-1] + 1, rows]
+        else:
+            values = self.block[positions, rows]
+        # The block holds one series per row, which is how pandas
+        # keeps a float DataFrame, so the transpose is not copied.
+        return pd.DataFrame(values.T, index=self.dates[rows],
+                columns=self.columns[positions])
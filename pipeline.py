@@ -0,0 +1,88 @@
+"""
+pipeline.py
+
+Parsing and cleaning in other processes.  RawData and clean are pure
+Python and hold the GIL, so however many threads wait on the network,
+one core does all the parsing.  ParsePool hands plain responses (from
+Obtain.fetch_raw(plain=True)) to a pool of processes, which send the
+cleaned DataFrames back as Arrow IPC streams, or pickles when pyarrow
+is not installed.
+
+Timings and counts of the work done in the pool stay in the worker
+processes' own stats.
+"""
+import cPickle as pickle
+import multiprocessing
+
+from clean import clean
+from obtain import parse
+
+def dumps(df):
+    """ DataFrame as bytes, for sending between processes. """
+    try:
+        import pyarrow
+    except ImportError:
+        return 'pickle', pickle.dumps(df, pickle.HIGHEST_PROTOCOL)
+    table = pyarrow.Table.from_pandas(df)
+    stream = pyarrow.BufferOutputStream()
+    writer = pyarrow.RecordBatchStreamWriter(stream, table.schema)
+    writer.write_table(table)
+    writer.close()
+    return 'arrow', stream.getvalue().to_pybytes()
+
+def loads(payload):
+    """ DataFrame from dumps(). """
+    kind, data = payload
+    if kind == 'pickle':
+        return pickle.loads(data)
+    import pyarrow
+    return pyarrow.ipc.open_stream(pyarrow.py_buffer(data)).read_all() \
+            .to_pandas()
+
+def _work(args):
+    raw, static, compact, clean_kwargs = args
+    rawdata = parse(raw, static=static, compact=compact)
+    if rawdata.data is None:
+        return rawdata.StatusType, None
+    return rawdata.StatusType, dumps(clean(rawdata, **clean_kwargs))
+
+class ParsePool(object):
+    def __init__(self, processes=None):
+        """
+        A pool of processes that turn responses into clean DataFrames.
+
+        Make the pool before starting any threads: the processes are
+        forked from this one.
+
+        Parameters:
+        -----------
+        processes: int (optional)
+            Defaults to the number of cores.
+        """
+        self._pool = multiprocessing.Pool(processes)
+
+    def submit(self, raw, static=None, compact=False, **kwargs):
+        """
+        Starts parsing raw, a response from Obtain.fetch_raw(plain=True),
+        and returns at once.  static and compact are passed to
+        obtain.parse(), other keyword arguments to clean().  Give the
+        returned AsyncResult to result().
+        """
+        return self._pool.apply_async(_work,
+                ((raw, static, compact, kwargs),))
+
+    @staticmethod
+    def result(async_result, timeout=None):
+        """
+        Waits for a submitted response.  Returns (StatusType, df), with
+        df None if the response has no data.  Errors in the worker are
+        raised here.
+        """
+        status, payload = async_result.get(timeout)
+        if payload is None:
+            return status, None
+        return status, loads(payload)
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
@@ -0,0 +1,70 @@
+"""
+planner.py
+
+Groups codes into requests so that each request only asks for the
+history its codes actually have.
+"""
+import datetime as dt
+
+import pandas as pd
+
+def plan_requests(start_dates, max_codes=16, max_length=1000,
+        max_spread=365):
+    """
+    Splits codes into batches of codes with similar start dates.
+
+    Codes are sorted by start date and then cut into batches of at
+    most max_codes codes.  A new batch is also started when the codes
+    would no longer fit in max_length characters, or when the start
+    dates in the batch would be more than max_spread days apart.
+    Each batch is requested from its earliest start date, so no code
+    is sent more than max_spread days of history it does not have.
+
+    Parameters:
+    -----------
+    start_dates: dict or list of (code, start_date) pairs
+        Missing start dates (None or NaT) are given the earliest
+        known start date.
+    max_codes: int
+        Datastream ignores codes after the 16th.
+    max_length: int
+        Longest comma-separated list of codes in one request.
+    max_spread: int
+        Days between the earliest and latest start date of a batch.
+
+    Returns:
+    --------
+    batches: list of (codes, start_date) tuples, ordered by start_date
+    """
+    if isinstance(start_dates, dict):
+        start_dates = start_dates.items()
+    start_dates = [(code, None if pd.isnull(date) else date)
+            for code, date in start_dates]
+    known = [date for code, date in start_dates if date is not None]
+    earliest = min(known) if len(known) > 0 else None
+    start_dates = [(code, earliest if date is None else date)
+            for code, date in start_dates]
+    if earliest is not None:
+        start_dates.sort(key=lambda pair: pair[1])
+    spread = dt.timedelta(days=max_spread)
+
+    batches = []
+    codes = []
+    length = 0
+    first = None
+    for code, date in start_dates:
+        too_long = length + len(code) + 1 > max_length + 1
+        too_spread = (first is not None and date is not None
+                and date - first > spread)
+        if codes and (len(codes) >= max_codes or too_long or too_spread):
+            batches.append((codes, first))
+            codes = []
+            length = 0
+            first = None
+        codes.append(code)
+        length += len(code) + 1
+        if first is None:
+            first = date
+    if codes:
+        batches.append((codes, first))
+    return batches
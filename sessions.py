@@ -0,0 +1,134 @@
+"""
+sessions.py
+
+Keeps authenticated Obtain objects around so that they can be
+shared between chunks and threads instead of building a new
+client (and re-reading ~/.netrc) for every request.
+"""
+import time
+import threading
+import warnings
+from Queue import Queue, Empty
+from contextlib import contextmanager
+
+from obtain import Obtain
+
+def check_session(session):
+    """
+    Default health check.  Asks DataWorks for its version, which is
+    about the cheapest call that goes over the wire.  Returns True
+    when the session can still talk to the server.
+    """
+    try:
+        session.version()
+    except Exception:
+        return False
+    return True
+
+class SessionPool(object):
+    def __init__(self, size=4, factory=Obtain, check=check_session,
+            check_after=300):
+        """
+        A fixed size pool of Obtain sessions.
+
+        Sessions are created the first time they are needed and are
+        then lent out with acquire() and given back with release().
+        A session that is returned as broken is thrown away and a
+        fresh one is made the next time one is needed.
+
+        Parameters:
+        -----------
+        size: int
+            Largest number of sessions that will exist at once.
+            This is also the limit on simultaneous requests.
+        factory: callable
+            Makes a new session.  Defaults to Obtain.
+        check: callable or None
+            Takes a session and returns False if it should be replaced.
+        check_after: int
+            Sessions that have been idle for more than this many seconds
+            are checked before they are lent out again.
+        """
+        self.size = size
+        self.factory = factory
+        self.check = check
+        self.check_after = check_after
+
+        self._idle = Queue()
+        self._lock = threading.Lock()
+        self._created = 0
+
+    def _new_session(self):
+        with self._lock:
+            if self._created >= self.size:
+                return None
+            self._created += 1
+        try:
+            return self.factory()
+        except:
+            with self._lock:
+                self._created -= 1
+            raise
+
+    def _discard(self, session):
+        with self._lock:
+            self._created -= 1
+        # Wake up anyone waiting so that they can make a replacement.
+        self._idle.put((None, None))
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a session.  Blocks until one is free.
+        """
+        while True:
+            try:
+                session, last_used = self._idle.get_nowait()
+            except Empty:
+                session = self._new_session()
+                if session is not None:
+                    return session
+                try:
+                    session, last_used = self._idle.get(timeout=timeout)
+                except Empty:
+                    raise RuntimeError("No Datastream session became free "
+                            "within {} seconds.".format(timeout))
+
+            if session is None:
+                # A slot was freed by a discarded session.
+                continue
+
+            stale = time.time() - last_used > self.check_after
+            if self.check is not None and stale and not self.check(session):
+                warnings.warn("Replacing a broken Datastream session.")
+                self._discard(session)
+                continue
+            return session
+
+    def release(self, session, broken=False):
+        """
+        Give a session back to the pool.  If broken is True the session
+        is dropped and will be replaced by a new one.
+        """
+        if broken:
+            self._discard(session)
+        else:
+            self._idle.put((session, time.time()))
+
+    @contextmanager
+    def session(self):
+        """
+        Context manager around acquire() and release().  The session is
+        treated as broken if anything other than a TypeError (which is
+        how Obtain reports missing data) escapes the block.
+        """
+        s = self.acquire()
+        try:
+            yield s
+        except TypeError:
+            self.release(s)
+            raise
+        except:
+            self.release(s, broken=True)
+            raise
+        else:
+            self.release(s)
@@ -0,0 +1,207 @@
+"""
+sinks.py
+
+Places to send cleaned data as it arrives, so that a large pull
+never has to be held in memory all at once.
+"""
+import os
+import warnings
+
+import pandas as pd
+
+class CSVSink(object):
+    def __init__(self, path, columns=None, append=False, **kwargs):
+        """
+        Appends DataFrames to a single csv file.
+
+        Parameters:
+        -----------
+        path: str
+        columns: list (optional)
+            Columns of the file.  If they are not given, the columns
+            of the first DataFrame are used.  Later DataFrames are
+            made to fit: missing columns are left empty and extra
+            columns are dropped with a warning.
+        append: bool
+            Add to the end of an existing file instead of replacing
+            it.  The file is assumed to already have a header.
+
+        Other keyword arguments are passed to DataFrame.to_csv().
+        """
+        self.path = os.path.expanduser(path)
+        self.columns = columns
+        self.kwargs = kwargs
+        self.kwargs.setdefault('encoding', 'utf-8')
+        self.kwargs.setdefault('index', False)
+        self._started = (append and os.path.exists(self.path)
+                and os.path.getsize(self.path) > 0)
+
+    def _conform(self, df):
+        if self.columns is None:
+            self.columns = df.columns.tolist()
+        extra = set(df.columns) - set(self.columns)
+        if len(extra) > 0:
+            warnings.warn("Dropping columns not in {}: {}".format(
+                self.path, sorted(extra)))
+        return df.reindex(columns=self.columns)
+
+    def write(self, df):
+        df = self._conform(df)
+        df.to_csv(self.path, mode='a' if self._started else 'w',
+                header=not self._started, **self.kwargs)
+        self._started = True
+
+    def close(self):
+        pass
+
+class ParquetSink(CSVSink):
+    def __init__(self, path, columns=None, **kwargs):
+        """
+        Writes DataFrames to a single Parquet file, one row group
+        per write.  Needs pyarrow.
+
+        Parameters:
+        -----------
+        path: str
+        columns: list (optional)
+            Same as for CSVSink.
+
+        Other keyword arguments are passed to pyarrow's ParquetWriter.
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("ParquetSink needs pyarrow.")
+        self._pa = pyarrow
+        CSVSink.__init__(self, path, columns=columns)
+        self.kwargs = kwargs
+        self._writer = None
+
+    def write(self, df):
+        df = self._conform(df)
+        if self._writer is None:
+            table = self._pa.Table.from_pandas(df, preserve_index=False)
+            self._writer = self._pa.parquet.ParquetWriter(self.path,
+                    table.schema, **self.kwargs)
+        else:
+            table = self._pa.Table.from_pandas(df, preserve_index=False,
+                    schema=self._writer.schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+class CallbackSink(object):
+    def __init__(self, callback):
+        """
+        Hands each DataFrame to callback(df).
+        """
+        self.callback = callback
+
+    def write(self, df):
+        self.callback(df)
+
+    def close(self):
+        pass
+
+class BufferedWriter(object):
+    def __init__(self, sink, max_memory=256*1024**2):
+        """
+        Collects DataFrames and passes them on to sink once they
+        take up more than max_memory bytes.  Use max_memory=0 to
+        write every DataFrame as soon as it arrives.
+        """
+        self.sink = sink
+        self.max_memory = max_memory
+        self.rows = 0
+        self._frames = []
+        self._size = 0
+
+    def write(self, df):
+        self._frames.append(df)
+        self._size += df.memory_usage(deep=True).sum()
+        if self._size >= self.max_memory:
+            self.flush()
+
+    def flush(self):
+        if len(self._frames) > 0:
+            df = pd.concat(self._frames)
+            self._frames = []
+            self._size = 0
+            self.sink.write(df)
+            self.rows += len(df)
+
+    def close(self):
+        self.flush()
+        self.sink.close()
+
+class PartitionedParquetSink(object):
+    # Columns that hold text.  DATE is a timestamp and everything
+    # else is treated as a numeric series.
+    text_columns = ['CCY', 'DISPNAME', 'FREQUENCY', 'SYMBOL']
+
+    def __init__(self, path, columns, partition_by='SYMBOL'):
+        """
+        Appends DataFrames to a Parquet dataset that is split into
+        one directory per code or per year.  Every write adds new
+        files, so nothing that is already written is read again.
+        Needs pyarrow.
+
+        Parameters:
+        -----------
+        path: str
+            Directory of the dataset.
+        columns: list
+            Every column of the dataset.  All writes use the same
+            schema: text_columns are strings, DATE is a timestamp and
+            the rest are float64.
+        partition_by: 'SYMBOL' or 'YEAR'
+            'YEAR' partitions by the year of DATE.
+        """
+        try:
+            import pyarrow
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("PartitionedParquetSink needs pyarrow.")
+        self._pa = pyarrow
+        self.path = os.path.expanduser(path)
+        self.columns = list(columns)
+        self.partition_by = partition_by
+
+        schema = []
+        for column in self.columns:
+            if column in self.text_columns:
+                schema.append(pyarrow.field(column, pyarrow.string()))
+            elif column == 'DATE':
+                schema.append(pyarrow.field(column, pyarrow.timestamp('ns')))
+            else:
+                schema.append(pyarrow.field(column, pyarrow.float64()))
+        if partition_by == 'YEAR':
+            schema.append(pyarrow.field('YEAR', pyarrow.int64()))
+        self.schema = pyarrow.schema(schema)
+
+    def write(self, df):
+        extra = set(df.columns) - set(self.columns)
+        if len(extra) > 0:
+            warnings.warn("Dropping columns not in {}: {}".format(
+                self.path, sorted(extra)))
+        df = df.reindex(columns=self.columns)
+        for column in self.columns:
+            if column in self.text_columns:
+                df[column] = df[column].astype(object)
+            elif column == 'DATE':
+                df[column] = pd.to_datetime(df[column])
+            else:
+                df[column] = pd.to_numeric(df[column], errors='coerce')
+        if self.partition_by == 'YEAR':
+            df['YEAR'] = df['DATE'].dt.year
+        table = self._pa.Table.from_pandas(df, schema=self.schema,
+                preserve_index=False)
+        self._pa.parquet.write_to_dataset(table, self.path,
+                partition_cols=[self.partition_by])
+
+    def close(self):
+        pass
@@ -0,0 +1,136 @@
+"""
+stats.py
+
+Timings and counts for the busy parts of a download: building the
+request, the network, parsing into RawData and cleaning.  Everything
+goes to the module level `stats` object, which keeps running totals
+and passes each event on to any hooks, e.g. to write a log.
+"""
+import os
+import json
+import time
+import threading
+from contextlib import contextmanager
+from collections import defaultdict
+
+class Stats(object):
+    def __init__(self):
+        """
+        Collects spans (named, timed pieces of work) and counters.
+
+        Stats.summary() gives the totals.  Every event is also passed
+        to each function in Stats.hooks as a dict with the keys
+        'type' ('span' or 'count'), 'name', 'time', 'thread', and
+        'duration' (spans) or 'value' (counters), plus any extra
+        information given when it was recorded.
+
+        Set Stats.measure_bytes to count the bytes of every response.
+        This needs the reply to be turned back into text, so it is
+        off by default.
+        """
+        self.hooks = []
+        self.measure_bytes = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.counters = defaultdict(int)
+            self.spans = defaultdict(lambda: {'count': 0, 'total': 0.,
+                'max': 0.})
+
+    def _emit(self, event):
+        for hook in self.hooks:
+            hook(event)
+
+    @contextmanager
+    def span(self, name, **info):
+        """
+        Times the block inside the with statement.
+        """
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            with self._lock:
+                span = self.spans[name]
+                span['count'] += 1
+                span['total'] += duration
+                span['max'] = max(span['max'], duration)
+            if self.hooks:
+                info.update(type='span', name=name, time=start,
+                        duration=duration, thread=threading.current_thread().ident)
+                self._emit(info)
+
+    def count(self, name, value=1, **info):
+        """
+        Adds value to the counter name.
+        """
+        with self._lock:
+            self.counters[name] += value
+        if self.hooks:
+            info.update(type='count', name=name, time=time.time(),
+                    value=value, thread=threading.current_thread().ident)
+            self._emit(info)
+
+    def summary(self):
+        """
+        Returns a dict of the counters, the spans (count, total and
+        max seconds) and the cache hit rate.
+        """
+        with self._lock:
+            summary = {'counters': dict(self.counters),
+                    'spans': dict([(k, dict(v)) for k, v in self.spans.items()])}
+        hits = summary['counters'].get('cache_hit', 0)
+        misses = summary['counters'].get('cache_miss', 0)
+        if hits + misses > 0:
+            summary['cache_hit_rate'] = 1.*hits/(hits+misses)
+        return summary
+
+class JSONLinesHook(object):
+    def __init__(self, path):
+        """
+        Stats hook that writes every event as a line of JSON.
+        """
+        self._file = open(os.path.expanduser(path), 'a')
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        line = json.dumps(event, default=str)
+        with self._lock:
+            self._file.write(line + '\n')
+
+    def close(self):
+        self._file.close()
+
+class ChromeTraceHook(object):
+    def __init__(self, path):
+        """
+        Stats hook that collects events and, on close(), writes them as
+        a Chrome trace file (open it in chrome://tracing or Perfetto).
+        """
+        self.path = os.path.expanduser(path)
+        self._events = []
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        args = dict([(k, v) for k, v in event.items() if k not in
+            ('type', 'name', 'time', 'duration', 'thread', 'value')])
+        trace = {'name': event['name'], 'pid': os.getpid(),
+                'tid': event['thread'], 'ts': event['time']*1e6}
+        if event['type'] == 'span':
+            trace.update(ph='X', dur=event['duration']*1e6, args=args)
+        else:
+            trace.update(ph='C', args={event['name']: event['value']})
+        with self._lock:
+            self._events.append(trace)
+
+    def close(self):
+        with self._lock:
+            events = self._events
+            self._events = []
+        with open(self.path, 'w') as f:
+            json.dump({'traceEvents': events}, f, default=str)
+
+stats = Stats()
@@ -6,29 +6,143 @@ most of the functions are just wrappers that customize the existing
 functionality of pydatastream and other packages.
 """
 import re
+import sys
+import copy
+import threading
 import warnings
+import collections
 import datetime as dt
 from netrc import netrc
 
 import numpy as np
 import pandas as pd
-import bokeh.palettes
-# from bokeh.plotting import vplot # This requires a new version of Bokeh.
-from bokeh.charts import TimeSeries, output_file, show
-
 from pydatastream import Datastream
 
+from obtain import Obtain, RawData, connect, single_flight
+from panel import build_panel, PanelStore
+from planner import plan_requests
+from stats import stats
+
+class _GovernedDatastream(Datastream):
+    """
+    Datastream whose requests go through a Governor, and are shared
+    with identical requests already on their way.
+    """
+    governor = None
+
+    def __init__(self, username, password):
+        connect(self, username, password)
+
+    def _request(self, *args, **kwargs):
+        if self.governor is None:
+            return Datastream.request(self, *args, **kwargs)
+        return self.governor.call(Datastream.request, self, *args, **kwargs)
+
+    def request(self, query, *args, **kwargs):
+        if args or kwargs:
+            return self._request(query, *args, **kwargs)
+        # An identical request already on its way is shared.
+        return single_flight(query, self._request, query)
+
+def _downsample(x, y, buckets=None):
+    """
+    Drops the missing values of the series y (at x) and, if there are
+    more than 2*buckets points, keeps only the smallest and largest
+    of each of buckets equal slices, in their order.
+    """
+    y = np.asarray(y, dtype=np.float64)
+    keep = np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if buckets is None or len(y) <= 2*buckets:
+        return x, y
+
+    size = -(-len(y) // buckets)
+    padded = np.empty(size*buckets)
+    padded[len(y):] = np.nan
+    padded[:len(y)] = y
+    padded = padded.reshape(buckets, size)
+    # Missing values are only at the end of the last slice.
+    low = np.argmin(np.where(np.isnan(padded), np.inf, padded), axis=1)
+    high = np.argmax(np.where(np.isnan(padded), -np.inf, padded), axis=1)
+    start = np.arange(buckets)*size
+    index = np.unique(np.concatenate([start + low, start + high]))
+    index = index[index < len(y)]
+    return x[index], y[index]
+
+def _read_ahead(func, items, ahead, max_memory):
+    """
+    Yields func(item) for every item, with a background thread
+    working up to `ahead` items in front of the caller, as long as the
+    waiting results take less than max_memory bytes.  Errors are
+    raised in the caller.
+    """
+    done = collections.deque()
+    state = {'bytes': 0, 'stop': False}
+    ready = threading.Condition()
+
+    def size(result):
+        try:
+            return result.memory_usage(index=True).sum()
+        except AttributeError:
+            return 0
+
+    def work():
+        for item in items:
+            with ready:
+                while not state['stop'] and len(done) > 0 and (
+                        len(done) >= ahead or state['bytes'] >= max_memory):
+                    ready.wait()
+                if state['stop']:
+                    return
+            try:
+                result = (True, func(item))
+            except Exception:
+                result = (False, sys.exc_info())
+            with ready:
+                done.append(result)
+                state['bytes'] += size(result[1]) if result[0] else 0
+                ready.notify_all()
+            if not result[0]:
+                return
+
+    thread = threading.Thread(target=work)
+    thread.daemon = True
+    thread.start()
+    try:
+        for i in xrange(len(items)):
+            with ready:
+                while len(done) == 0:
+                    # With a timeout, so that Ctrl-C gets through.
+                    ready.wait(1.)
+                ok, result = done.popleft()
+                state['bytes'] -= size(result) if ok else 0
+                ready.notify_all()
+            if not ok:
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        with ready:
+            state['stop'] = True
+            ready.notify_all()
+
 class streamer(object):
-    def __init__(self):
+    def __init__(self, governor=None):
         """
         Reads in credentials from the user's .netrc file and creates
         a Datastream object to be used in fetching data.
+
+        Parameters:
+        -----------
+        governor: Governor (optional)
+            Paces and retries requests.  See governor.py.
         """
         rc = netrc()
         uname, account, passwd = rc.authenticators('datastream')
-        self.DWE = Datastream(username=uname, password=passwd)
+        self.DWE = _GovernedDatastream(username=uname, password=passwd)
+        self.DWE.governor = governor
 
-    def _fetch_individual_code(self, code, fields=None, **kwargs):
+    def _fetch_individual_code(self, code, fields=None, rename=True,
+            **kwargs):
         """
         Internal function to fetch the data.
         It offers two advantages to the original:
@@ -37,20 +151,85 @@ class streamer(object):
                 want to know when one fails, but move on.
             (2) It renames the colums so that they have the code as a part
                 of the column name, not just the field.  This 
+                is skipped when rename is False.
         """
         print(code) #TEMP
         try:
-            df = self.DWE.fetch(code, fields=fields, **kwargs)
+            with stats.span('network', code=code):
+                df = self.DWE.fetch(code, fields=fields, **kwargs)
         except Exception, e:
+            stats.count('failures', code=code)
             df = None
             warnings.warn(("Unable to load {} \n".format(code) 
                 + str(e.message) + '\n'))
         else:
             if fields==None:
                 fields=['D']
-            df.columns = [code + "({})".format(column) for column in df.columns]
+            if rename:
+                df.columns = [code + "({})".format(column)
+                        for column in df.columns]
         return df
 
+    def _fetch_batch(self, codes, fields=None, date_from=None, freq='D'):
+        """
+        Fetches up to 16 codes that share a start date in one request.
+
+        Returns a list of (code, DataFrame) pairs like those of
+        _fetch_individual_code(rename=False); the DataFrame is None
+        for codes that failed, with a warning.  If the request itself
+        fails, the codes are fetched one at a time instead, and if
+        Datastream turns it down or the response cannot be read (one
+        bad code spoils all of them) its halves are tried separately.
+        """
+        if isinstance(fields, (str, unicode)):
+            fields = [fields]
+        if date_from is not None:
+            date_from = pd.Timestamp(date_from)
+        query = Obtain._construct_request(list(codes), fields=fields,
+                start_date=date_from, freq=freq)
+        try:
+            with stats.span('network', request=query):
+                raw = list(self.DWE.request(query))
+        except Exception:
+            if date_from is not None:
+                date_from = date_from.strftime('%Y-%m-%d')
+            return [(code, self._fetch_individual_code(code, fields=fields,
+                date_from=date_from, freq=freq, rename=False))
+                for code in codes]
+        raw.append(list(codes))
+        try:
+            rawdata = RawData(raw)
+        except TypeError, e:
+            # One code's response cannot be read, e.g. a series
+            # without values.  Treated like a batch that is turned down.
+            rawdata = None
+            error = str(e)
+        if (rawdata is None or rawdata.data is None) and len(codes) > 1:
+            half = len(codes) // 2
+            return (self._fetch_batch(codes[:half], fields, date_from, freq)
+                    + self._fetch_batch(codes[half:], fields, date_from, freq))
+        if rawdata is None:
+            stats.count('failures', code=codes[0])
+            warnings.warn("Unable to load {} \n{}\n".format(codes[0], error))
+            return [(codes[0], None)]
+
+        frames = []
+        for k, code in enumerate(codes):
+            df = None
+            if rawdata.data is not None:
+                non_array, array_data = rawdata.data[k]
+                columns = [f for f in (fields or sorted(array_data))
+                        if f in array_data and f != 'DATE']
+                if 'DATE' in array_data and columns:
+                    df = pd.DataFrame(array_data).set_index('DATE')[columns]
+                    df.index.name = 'Date'
+            if df is None:
+                stats.count('failures', code=code)
+                warnings.warn("Unable to load {} \n{}\n".format(code,
+                    rawdata.StatusMessage or ''))
+            frames.append((code, df))
+        return frames
+
     def _decode_columns(self, human_codes, inverse=False):
         """
         Changes column names created by fetch to be
@@ -86,16 +265,23 @@ class streamer(object):
         if inverse:
             human_codes = inverse_dict(human_codes)
 
+        if isinstance(self.content.columns, pd.MultiIndex):
+            # Columns from fetch(multiindex=True): (code, field).
+            self.content.columns = pd.MultiIndex.from_tuples(
+                    [(human_codes[code], field) for code, field in
+                        self.content.columns], names=['code', 'field'])
+            return
+
         self.content.columns = [human_codes[strip_fields(column)]+' '+
                 get_fields(column) for column in self.content.columns] 
 
     def fetch(self, codes, fields=None, date_from=None, start_date=None, 
-            human_columns=None, **kwargs):
+            human_columns=None, multiindex=False, batch=True, **kwargs):
         """
         Wrapper for the Datastream fetch to generate a 
         DataFrame with the codes as columns. This uses
-        fetch_individual_code and then concatenates the
-        data.  For more information, see the documentation
+        _fetch_batch (or fetch_individual_code) and then
+        puts the data side by side.  For more information, see the documentation
         for the pydatastream fetch command.
 
         Parameters:
@@ -114,6 +300,15 @@ class streamer(object):
             'code':'Human Readable Code Name', and cannot be missing
             any of the codes.
 
+        multiindex: bool (optional)
+            Label the columns with a MultiIndex of (code, field)
+            instead of "CODE(FIELD)" strings.
+
+        batch: bool (optional)
+            Ask for up to 16 codes with the same start date in one
+            request.  Only freq can be given as another keyword
+            argument; with any other the codes are fetched one by one.
+
         Returns:
         --------
         data: DataFrame
@@ -125,29 +320,45 @@ class streamer(object):
         if date_from == None and start_date != None:
             date_from = start_date
         
-        if start_date == None:
-            raw_data = [self._fetch_individual_code(code, 
-                fields=fields, 
-                **kwargs) 
-                for code in codes]
-        elif type(date_from) == str:
-            raw_data = [self._fetch_individual_code(code, 
-                fields=fields, date_from=date_from, **kwargs) for code in codes]
-        elif type(date_from) == dict:
+        if type(date_from) == dict:
             # When the code is not in the dictionary, date_from.get(code) 
             # returns None instead of a KeyError.
-            raw_data = [self._fetch_individual_code(code, fields=fields, 
-                date_from=date_from.get(code), **kwargs) for code in codes]
+            dates = [(code, date_from.get(code)) for code in codes]
+        else:
+            dates = [(code, date_from) for code in codes]
+        dates = [(code, None if date is None or pd.isnull(date) else date)
+                for code, date in dates]
+
+        if batch and set(kwargs) <= set(['freq']):
+            fetched = {}
+            # max_spread=0: only codes with the very same start date
+            # share a request.  Codes without one are kept apart.
+            for undated in [False, True]:
+                group = [(code, None if undated else pd.Timestamp(date))
+                        for code, date in dates if (date is None) == undated]
+                if not group:
+                    continue
+                for batch_codes, batch_date in plan_requests(group,
+                        max_spread=0):
+                    fetched.update(self._fetch_batch(batch_codes,
+                        fields=fields, date_from=batch_date, **kwargs))
+            raw_data = [(code, fetched[code]) for code in codes]
+        else:
+            raw_data = [(code, self._fetch_individual_code(code,
+                fields=fields, date_from=date, rename=False, **kwargs))
+                for code, date in dates]
 
         # Remove entries that are None
-        raw_data = [df for df in raw_data if type(df)==pd.core.frame.DataFrame]
+        raw_data = [(code, df) for code, df in raw_data
+                if type(df)==pd.core.frame.DataFrame]
 
-        # Concatenate the results
-        data = pd.concat(raw_data, axis=1)
+        # Put the results side by side
+        data = build_panel(raw_data, multiindex=multiindex)
         
         self.content = data
         if type(human_columns) == dict:
-            data = self._decode_columns(human_columns)
+            self._decode_columns(human_columns)
+            data = self.content
 
 
         return data
@@ -171,38 +382,50 @@ class streamer(object):
             self.fetch(df.code, start_date=start_date, **kwargs)
         return self.content
 
-    def parse_csv_buffered(self, path, human_cols=False, buffer=10, **kwargs):
+    def parse_csv_buffered(self, path, human_cols=False, buffer=10,
+            read_ahead=0, max_memory=256*1024**2, **kwargs):
+        """
+        Like parse_csv, but yields the data buffer codes at a time
+        (also kept in self.content).
+
+        Parameters:
+        -----------
+        read_ahead: int (optional)
+            Batches to fetch in the background while the caller works
+            on the current one.  0 fetches each batch only when it is
+            asked for.
+        max_memory: int (optional)
+            Bytes of fetched batches that may wait to be yielded.  At
+            least one batch is always fetched ahead.
+        """
         df = pd.read_csv(path, usecols=['Symbol', 'Start Date', 'Full Name'],
                 parse_dates=[1])
         df.columns = ['code', 'date_from', 'name']
         start_date = dict(zip(df.code, df.date_from))
-        human_columns = dict(zip(df.code, df.name))
-
-        total_len = len(df)
-        n = 0
-        while n < total_len-buffer:
-            if human_cols:
-                yield self.fetch(df.code.iloc[n:n+buffer], 
-                        start_date=start_date, human_columns=human_columns, 
-                        **kwargs)
-            else:
-                yield self.fetch(df.code.iloc[n:n+buffer], 
-                        start_date=start_date, 
-                        **kwargs)
-            n += buffer
-
-        while total_len-buffer<= n:
-            if human_cols:
-                yield self.fetch(df.code.iloc[n:], 
-                        start_date=start_date, human_columns=human_columns, 
-                        **kwargs)
-            else:
-                yield self.fetch(df.code.iloc[n:], 
-                        start_date=start_date, 
-                        **kwargs)
+        if human_cols:
+            kwargs['human_columns'] = dict(zip(df.code, df.name))
+
+        batches = [df.code.iloc[n:n+buffer] for n in
+                xrange(0, len(df), buffer)]
+
+        if read_ahead <= 0:
+            for codes in batches:
+                yield self.fetch(codes, start_date=start_date, **kwargs)
+            return
+
+        # A shallow copy keeps the background fetches from replacing
+        # self.content while the caller is using it.  It shares DWE,
+        # which is only used from the background thread meanwhile.
+        worker = copy.copy(self)
+        fetch = lambda codes: worker.fetch(codes, start_date=start_date,
+                **kwargs)
+        for data in _read_ahead(fetch, batches, read_ahead, max_memory):
+            self.content = data
+            yield data
 
     def plot(self, pct=False,
-            output_file_path='temp_plot.html', title="", legend=True):
+            output_file_path='temp_plot.html', title="", legend=True,
+            width=800, height=350, downsample=True, webgl=True):
         """
         Allows the user to plot the timeseries data in self.content 
         using Bokeh. 
@@ -210,50 +433,56 @@ class streamer(object):
         Parameters
         ----------
         pct: bool
-            Transformes the data to be percent change.
+            Also plots the percent change, below.
         output_file_path: str
             Path, including the name, for the output file.
         title: str
             The title of the graph and the html page.
         legend: bool
-             Whether to include the legend or not.
+             Whether to include the legend or not.  Clicking an entry
+             hides its series.
+        width, height: int
+            Size of each graph in pixels.
+        downsample: bool
+            Keep only the smallest and largest value of each series
+            in each of `width` slices of the dates, so at most two
+            points per pixel go into the file.  The lines look the
+            same, but even decades of daily data for hundreds of codes
+            make a file the browser can open.
+        webgl: bool
+            Draw the lines with WebGL, which copes with many more.
         """
+        # Bokeh is slow to import, so only when plotting.
+        from bokeh.layouts import column
+        from bokeh.palettes import Category10, Category20
+        from bokeh.plotting import figure, output_file, show
+
         # Output to static HTML file
         output_file(output_file_path, title=title)
 
-        no_cols_needed = len(self.content.columns)
-        if no_cols_needed == 3: Spectral = bokeh.palettes.Spectral3
-        if no_cols_needed == 4: Spectral = bokeh.palettes.Spectral4
-        if no_cols_needed == 5: Spectral = bokeh.palettes.Spectral5
-        if no_cols_needed == 6: Spectral = bokeh.palettes.Spectral6
-        if no_cols_needed == 7: Spectral = bokeh.palettes.Spectral7
-        if no_cols_needed == 8: Spectral = bokeh.palettes.Spectral8
-        if no_cols_needed == 9: Spectral = bokeh.palettes.Spectral9
-        if no_cols_needed == 10: Spectral = bokeh.palettes.Spectral10
-        if no_cols_needed >= 11: Spectral = bokeh.palettes.Spectral11
-
-
-        data = self.content
-        # Bokeh stumbles if the series starts with a nan.  
-        # Hopefully will be fixed in Bokeh 0.9.4
-        data = data.dropna(thresh=len(data.columns), axis=1)
-        data.iloc[0] = data.iloc[0].fillna(0)
-
-        p = TimeSeries(data, legend=legend, title=title, 
-                width=800, height=350)
-                # width=800, height=350, palette=Spectral)
-
+        def graph(data, title):
+            p = figure(title=title, x_axis_type='datetime', width=width,
+                    height=height,
+                    output_backend='webgl' if webgl else 'canvas')
+            palette = Category10[10] if len(data.columns) <= 10 \
+                    else Category20[20]
+            buckets = width if downsample else None
+            for k, name in enumerate(data.columns):
+                x, y = _downsample(data.index.values, data[name].values,
+                        buckets)
+                line = dict(color=palette[k % len(palette)], line_width=1.5)
+                if legend:
+                    line['legend_label'] = unicode(name)
+                p.line(x, y, **line)
+            if legend:
+                p.legend.click_policy = 'hide'
+                p.legend.location = 'top_left'
+            return p
+
+        plots = [graph(self.content, title)]
         if pct:
-            data2 = self.content.pct_change()
-            data2 = data2.dropna(thresh=len(data2.columns), axis=1)
-            data2.iloc[0] = data2.iloc[0].fillna(0)
-            p2 = TimeSeries(data2, legend=legend, title="Percent Change", 
-                width=800, height=350)
-                # width=800, height=350, palette=Spectral)
-            # show(vplot(p,p2))
-            show(p2)
-        else:
-            show(p)
+            plots.append(graph(self.content.pct_change(), "Percent Change"))
+        show(column(*plots))
 
     def request(self, request_string):
         """
@@ -278,6 +507,14 @@ class streamer(object):
         """
         self.content.to_csv(filename, **kwargs)
 
+    def to_store(self, path):
+        """
+        Saves self.content as a memory-mapped PanelStore (see
+        panel.py), which other processes can open without reading
+        it all in.
+        """
+        return PanelStore.write(path, self.content)
+
 
 
 
@@ -294,7 +531,7 @@ if __name__=='__main__':
     stream = streamer()
     n = 300
     for f in stream.parse_csv_buffered('ChinaFirmsDatastreamCodes_end.csv', 
-            buffer=150):
+            buffer=150, read_ahead=2):
         stream.content.to_csv('ChinaFirmNew{}.csv'.format(n))
         print(n)
         n += 1
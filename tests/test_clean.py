@@ -0,0 +1,92 @@
+"""
+The fast path of clean() must give exactly what the original method
+gives, dtypes included.
+"""
+import datetime as dt
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from pandas.util.testing import assert_frame_equal
+
+from cache import Record
+from clean import clean
+from obtain import RawData
+
+DATES = [dt.datetime(2000, 1, 3) + dt.timedelta(days=k) for k in xrange(3)]
+
+def field(name, value=None, array=None):
+    if array is not None:
+        return Record([('Name', name),
+            ('ArrayValue', Record([('anyType', array)]))])
+    return Record([('Name', name), ('Value', value)])
+
+def response(series):
+    """
+    Raw response for [(code, {field: list of values})], where a code
+    with no fields comes back as INSTERROR.
+    """
+    fields = []
+    for k, (code, values) in enumerate(series):
+        suffix = '' if k == 0 else '_{}'.format(k+1)
+        if not values:
+            fields.append(field('INSTERROR'+suffix, '$$"ER", E100'))
+            continue
+        fields.append(field('DATE'+suffix, array=DATES))
+        for name, array in sorted(values.items()):
+            fields.append(field(name+suffix, array=array))
+        fields += [field('CCY'+suffix, 'U$'),
+                field('DISPNAME'+suffix, 'NAME ' + code),
+                field('FREQUENCY'+suffix, 'D')]
+    raw = [('Source', 'x'), ('Instrument', ','.join([c for c, v in series])),
+            ('StatusType', 'Connected'), ('StatusCode', 0),
+            ('StatusMessage', ''),
+            ('Fields', Record([('Field', fields)]))]
+    raw.append([code for code, values in series])
+    return raw
+
+CASES = {
+    'floats': [('A', {'P': [1., 2., 3.]}), ('B', {'P': [4., 5., 6.]})],
+    'all none': [('A', {'P': [1., None, 3.]}), ('B', {'P': [None]*3})],
+    'only none': [('A', {'P': [None]*3}), ('B', {'P': [None]*3})],
+    'ints and none': [('A', {'P': [1, 2, 3]}), ('B', {'P': [None]*3})],
+    'none beside text': [('A', {'P': [1., 2., 3.], 'X': [u'a']*3}),
+        ('B', {'P': [None]*3})],
+    'missing field': [('A', {'P': [1., 2., 3.], 'MV': [None]*3}),
+        ('B', {'P': [4., 5., 6.]})],
+    'text': [('A', {'P': [1., 2., 3.], 'X': [u'a', u'b', None]}),
+        ('B', {'P': [4., 5., 6.], 'X': [None]*3})],
+    'insterror': [('BAD1', {}), ('A', {'P': [1., None, 3.]}), ('BAD2', {})],
+    'only insterror': [('BAD1', {}), ('BAD2', {})],
+}
+
+class TestFastClean(unittest.TestCase):
+    def check(self, name, raw):
+        try:
+            expected = clean(raw, fast=False)
+        except Exception as e:
+            self.assertRaises(type(e), clean, raw)
+            return
+        try:
+            assert_frame_equal(clean(raw), expected,
+                    check_index_type='equiv')
+        except AssertionError as e:
+            raise AssertionError("{}: {}".format(name, e))
+
+    def test_same_as_original(self):
+        for compact in (False, True):
+            for name, series in sorted(CASES.items()):
+                raw = RawData(response(series), compact=compact)
+                self.check(name, raw)
+
+    def test_list_same_as_original(self):
+        for compact in (False, True):
+            for name, series in sorted(CASES.items()):
+                raws = [RawData(response(series[:1]), compact=compact),
+                        RawData(response(series[1:]), compact=compact)]
+                self.check(name, raws)
+
+if __name__ == '__main__':
+    unittest.main()
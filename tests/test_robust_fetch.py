@@ -0,0 +1,79 @@
+"""
+robust_fetch must not journal codes whose rows never reached the disk,
+so that resume=True fetches them again.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import pandas as pd
+
+import sinks
+import utils
+
+CODES = ['C{:02d}'.format(k) for k in xrange(25)]
+
+class FakeObtain(object):
+    def fetch(self, codes, fields=None, **kwargs):
+        return codes[0]
+
+def fake_clean(code):
+    if code.startswith('BAD'):
+        raise TypeError(code)
+    return pd.DataFrame({'SYMBOL': [code], 'DATE': [pd.Timestamp('2000-01-03')],
+        'P': [1.0], 'CCY': ['U$'], 'DISPNAME': [code], 'FREQUENCY': ['D']})
+
+class FailingCSVSink(sinks.CSVSink):
+    """ CSVSink whose writes fail from the fail_at-th one on. """
+    fail_at = None
+
+    def __init__(self, *args, **kwargs):
+        super(FailingCSVSink, self).__init__(*args, **kwargs)
+        self.writes = 0
+
+    def write(self, df):
+        self.writes += 1
+        if self.fail_at is not None and self.writes >= self.fail_at:
+            raise IOError("No space left on device")
+        super(FailingCSVSink, self).write(df)
+
+class TestRobustFetch(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self._saved = utils.Obtain, utils.clean, utils.CSVSink
+        utils.Obtain, utils.clean, utils.CSVSink = \
+                FakeObtain, fake_clean, FailingCSVSink
+
+    def tearDown(self):
+        utils.Obtain, utils.clean, utils.CSVSink = self._saved
+        FailingCSVSink.fail_at = None
+        shutil.rmtree(self.out_dir)
+
+    def written(self):
+        df = pd.read_csv(os.path.join(self.out_dir, 'out.csv'))
+        return sorted(df.SYMBOL)
+
+    def test_failed_write_is_fetched_on_resume(self):
+        FailingCSVSink.fail_at = 2
+        self.assertRaises(IOError, utils.robust_fetch, CODES, self.out_dir)
+        done, _ = utils.Journal(os.path.join(self.out_dir,
+            'journal.log')).read()
+        self.assertEqual(sorted(done), CODES[:10])
+        self.assertEqual(self.written(), CODES[:10])
+
+        FailingCSVSink.fail_at = None
+        utils.robust_fetch(CODES, self.out_dir, resume=True)
+        self.assertEqual(self.written(), CODES)
+
+    def test_fresh_run_replaces_output(self):
+        utils.robust_fetch(CODES, self.out_dir)
+        utils.robust_fetch(['BAD1', 'BAD2', 'BAD3'], self.out_dir)
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir,
+            'out.csv')))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,12 +1,18 @@
+import os
+import shutil
+from multiprocessing.pool import ThreadPool
+
 from obtain import Obtain
 from pandas import DataFrame, concat
-from subprocess import call
-
-from numpy import NaN
 
 from clean import clean
+from journal import Journal
+from pipeline import ParsePool
+from sessions import SessionPool
+from sinks import BufferedWriter, CSVSink, PartitionedParquetSink
 
-DatastreamDir = "~/python_modules/datastream/"
+# Columns that clean() adds to every code, besides the fields.
+META_COLUMNS = ['CCY', 'DATE', 'DISPNAME', 'FREQUENCY', 'SYMBOL']
 
 def chunks(codes, n):
     """
@@ -15,7 +21,38 @@ def chunks(codes, n):
     for i in xrange(0, len(codes), n):
         yield codes[i:i+n]
 
-def fetch(codes, n, **kwargs):
+def map_chunks(func, chunked, max_workers=1, window=None):
+    """
+    Applies func to every chunk, using up to max_workers threads,
+    and yields the results in the same order as the chunks.
+
+    When window is given, at most window chunks are worked on
+    before their results are handed back.  This keeps the number of
+    finished but unused results (and their memory) bounded.
+    """
+    if max_workers <= 1:
+        for chunk in chunked:
+            yield func(chunk)
+        return
+
+    # The work is almost entirely waiting on the network, so threads
+    # are enough.  ThreadPool keeps the chunks in input order.
+    pool = ThreadPool(max_workers)
+    try:
+        if window is None:
+            for result in pool.imap(func, chunked):
+                yield result
+        else:
+            for group in chunks(list(chunked), window):
+                for result in pool.map(func, group):
+                    yield result
+    finally:
+        pool.close()
+        pool.join()
+
+def fetch(codes, n, max_workers=1, sessions=None, sink=None,
+        max_memory=256*1024**2, bisect=True, governor=None, processes=0,
+        **kwargs):
     """
     This is a shortcut to downloading Datastream data.  It
     chunks codes into pieces of size n, then fetches and cleans
@@ -25,6 +62,35 @@ def fetch(codes, n, **kwargs):
     -----------
     codes: Numpy array or list
     n: int
+    max_workers: int (optional)
+        Number of chunks that are downloaded at the same time.
+        The default of 1 downloads the chunks one after another.
+        Results are returned in the same order as codes regardless
+        of the number of workers.
+    sessions: SessionPool (optional)
+        Pool of Obtain sessions to borrow from.  If it is not given
+        a pool with max_workers sessions is made for this call.
+    governor: Governor (optional)
+        Paces and retries the requests of the sessions made for this
+        call.  Ignored when sessions is given.
+    sink: CSVSink, ParquetSink, CallbackSink (optional)
+        When given, each chunk is cleaned and written to sink as
+        soon as it arrives instead of being returned.  The
+        DataFrame that is returned is then empty.
+    max_memory: int (optional)
+        Bytes of cleaned data to hold before writing to sink.
+    bisect: bool (optional)
+        When a chunk fails (a TypeError or StatusType 5), split it in
+        half and try each half, until the bad codes are found.  One
+        bad code then costs about 2*log2(n) extra requests instead
+        of n.  With bisect=False each code of a chunk that raised a
+        TypeError is requested on its own, as before.
+    processes: int (optional)
+        Parse and clean the responses in this many worker processes
+        (see pipeline.py), so that the threads only wait on the
+        network.  Chunks are always bisected then, also when their
+        response cannot be parsed.  Call fetch before starting other
+        threads.
 
     Keyword arguments are the same as Obtain.fetch()
         As of December 2015:
@@ -64,49 +130,205 @@ def fetch(codes, n, **kwargs):
             Number of years ago the series should start
     """
 
+    if sessions is None:
+        sessions = SessionPool(size=max_workers, 
+                factory=lambda: Obtain(governor=governor))
+
     broken = [] # codes that didn't work
-    def fetch_chunk(chunk):
+    def fetch_halves(o, chunk):
+        """ Fetches chunk, splitting it in two for as long as it fails. """
         try:
-            pieces = [Obtain().fetch(chunk, **kwargs)]
+            raw = o.fetch(chunk, **kwargs)
         except TypeError:
             # When the data didn't exist or something else went wrong
-            pieces = []
-            for piece in chunk:
-                try:
-                    pieces.append(Obtain().fetch([piece], **kwargs))
-                except TypeError:
-                    broken.append(piece)
-        if len(pieces)>0:
-            return pieces
+            raw = None
+        if raw is not None and (raw.StatusType!=5 or len(chunk)==1):
+            return [raw]
+        if len(chunk)==1:
+            broken.extend(chunk)
+            return []
+        half = len(chunk)//2
+        return fetch_halves(o, chunk[:half]) + fetch_halves(o, chunk[half:])
 
-    # List of lists
+    def fetch_chunk(chunk):
+        with sessions.session() as o:
+            if bisect:
+                return fetch_halves(o, list(chunk))
+            try:
+                pieces = [o.fetch(chunk, **kwargs)]
+            except TypeError:
+                # When the data didn't exist or something else went wrong
+                pieces = []
+                for piece in chunk:
+                    try:
+                        pieces.append(o.fetch([piece], **kwargs))
+                    except TypeError:
+                        broken.append(piece)
+        return pieces
+
+    def drop_failed(pieces):
+        """ Moves the codes of failed requests into broken. """
+        for item in pieces:
+            if item.StatusType==5:
+                broken.extend(item.Codes)
+        return [item for item in pieces if item.StatusType!=5]
 
     try:
-        chunked = chunks(codes.dropna(), n)
+        codes = codes.dropna()
     except AttributeError:
-        chunked = chunks(codes, n)
-    chunk_lists = [fetch_chunk(c) for c in chunked]
+        pass
+    chunked = chunks(codes, n)
+
+    if kwargs.get('static_fields') is not None:
+        # Look up the static fields for the whole universe at once.
+        # The chunks then find them in Obtain's static cache.
+        with sessions.session() as o:
+            o.fetch_static(list(codes), kwargs['static_fields'])
+
+    if processes:
+        return _fetch_in_processes(chunked, max_workers, sessions, sink,
+                max_memory, processes, kwargs)
+
+    if sink is not None:
+        writer = BufferedWriter(sink, max_memory=max_memory)
+        try:
+            for pieces in map_chunks(fetch_chunk, chunked, max_workers,
+                    window=max_workers):
+                suceeded = drop_failed(pieces)
+                if len(suceeded) == 0:
+                    continue
+                try:
+                    df = clean(suceeded)
+                except:
+                    # Nothing from this chunk is written.
+                    broken.extend([code for item in suceeded 
+                        for code in item.Codes])
+                else:
+                    writer.write(df)
+        finally:
+            writer.close()
+        return DataFrame(), broken
+
+    # List of lists
+    chunk_lists = list(map_chunks(fetch_chunk, chunked, max_workers))
     flattened = [item for sublist in chunk_lists for item in sublist]
-    failed = [item.Codes for item in flattened if item.StatusType==5]
-    failed = [item for sublist in failed for item in sublist]
-    broken.extend(failed)
-    suceeded = [item for item in flattened if item.StatusType!=5]
+    suceeded = drop_failed(flattened)
     try:
         return clean(suceeded), broken
     except:
         return DataFrame(), broken
     # return clean([item for sublist in chunk_lists for item in sublist]), broken
 
+def _fetch_in_processes(chunked, max_workers, sessions, sink, max_memory,
+        processes, kwargs):
+    """
+    fetch() with a ParsePool doing the parsing and cleaning.  The
+    threads make the requests and hand the responses straight on.
+    """
+    kwargs = dict(kwargs)
+    static_fields = kwargs.pop('static_fields', None)
+    compact = kwargs.pop('compact', False)
+    pool = ParsePool(processes)
+    broken = [] # codes that didn't work
+
+    def request_halves(o, chunk):
+        """ Requests chunk, splitting it in two for as long as it fails. """
+        try:
+            raw = o.fetch_raw(chunk, plain=True, **kwargs)
+        except TypeError:
+            raw = None
+        if raw is not None and (raw[2][1]!=5 or len(chunk)==1):
+            static = None
+            if static_fields is not None:
+                static = o.fetch_static(chunk, static_fields)
+            return [(chunk, pool.submit(raw, static=static, compact=compact))]
+        if len(chunk)==1:
+            broken.extend(chunk)
+            return []
+        half = len(chunk)//2
+        return request_halves(o, chunk[:half]) + request_halves(o, chunk[half:])
+
+    def request_chunk(chunk):
+        with sessions.session() as o:
+            return request_halves(o, list(chunk))
+
+    def collect(submitted):
+        """ Cleaned DataFrames of the submitted responses. """
+        frames = []
+        for chunk, result in submitted:
+            try:
+                status, df = pool.result(result)
+            except Exception:
+                # Parsing failed, as o.fetch can in the threads: ask for
+                # the halves again until the code that fails is alone.
+                if len(chunk)==1:
+                    broken.extend(chunk)
+                    continue
+                half = len(chunk)//2
+                with sessions.session() as o:
+                    again = (request_halves(o, chunk[:half])
+                            + request_halves(o, chunk[half:]))
+                frames.extend(collect(again))
+                continue
+            if status==5:
+                broken.extend(chunk)
+            elif df is not None:
+                frames.append(df)
+        return frames
+
+    try:
+        if sink is not None:
+            writer = BufferedWriter(sink, max_memory=max_memory)
+            try:
+                for submitted in map_chunks(request_chunk, chunked,
+                        max_workers, window=max_workers):
+                    for df in collect(submitted):
+                        writer.write(df)
+            finally:
+                writer.close()
+            return DataFrame(), broken
+
+        chunk_lists = list(map_chunks(request_chunk, chunked, max_workers))
+        frames = collect([item for sublist in chunk_lists
+            for item in sublist])
+    finally:
+        pool.close()
+    try:
+        return concat(frames), broken
+    except:
+        return DataFrame(), broken
+
 def robust_fetch(codes, out_dir="~/data/datastream/", 
-        fields=["P"], **kwargs):
+        fields=["P"], output="csv", partition_by="SYMBOL", resume=False,
+        **kwargs):
     """
     This is a shortcut to downloading Datastream data.  It
     downloads codes individually to be more robust.
 
+    The data are appended to out_dir/out.csv (or the Parquet
+    dataset out_dir/out.parquet) every 10 codes.  Every write has
+    the same columns, the fields and static fields plus the
+    metadata in META_COLUMNS, in sorted order.  Codes that could not
+    be downloaded are listed in out_dir/failed.csv.
+
+    Progress is kept in out_dir/journal.log.  A code is marked done
+    only after its data have been written, so with resume=True a
+    job that crashed can carry on from where it stopped.
+
     Parameters:
     -----------
     codes: numpy array or list
     out_dir: str
+    output: 'csv' or 'parquet'
+        'parquet' needs pyarrow.
+    partition_by: 'SYMBOL' or 'YEAR'
+        How the Parquet dataset is split up.  Ignored for csv.
+    resume: bool
+        Skip the codes that the journal says are done and add to the
+        existing output.  Codes that failed before are tried again.
+        Use the same fields and output as the first run.  If the job
+        stopped between a write and the journal update, up to 10
+        codes can appear twice in the output.
 
     Keyword arguments are the same as Obtain.fetch()
         As of December 2015:
@@ -145,53 +367,78 @@ def robust_fetch(codes, out_dir="~/data/datastream/",
         n_days: int
             Number of years ago the series should start
     """
+    out_dir = os.path.expanduser(out_dir)
     if out_dir[-1]!='/':
         out_dir+='/'
-    call(["rm", out_dir+"file*.tmp"])
 
-    header = True # useful to check things
+    static_fields = kwargs.get('static_fields') or []
+    if isinstance(static_fields, basestring):
+        static_fields = [static_fields]
+    columns = sorted(set(fields) | set(static_fields) | set(META_COLUMNS))
+
+    journal = Journal(out_dir+"journal.log")
+    if resume:
+        done, _ = journal.read()
+        codes = [code for code in codes if code not in done]
+    else:
+        journal.clear()
+        if os.path.isdir(out_dir+"out.parquet"):
+            shutil.rmtree(out_dir+"out.parquet")
+        if os.path.exists(out_dir+"out.csv"):
+            os.remove(out_dir+"out.csv")
+
+    if output == "parquet":
+        sink = PartitionedParquetSink(out_dir+"out.parquet", columns,
+                partition_by=partition_by)
+    else:
+        sink = CSVSink(out_dir+"out.csv", columns=columns, append=resume)
+    # Memory is not the concern here; writes happen every 10 codes.
+    writer = BufferedWriter(sink, max_memory=float('inf'))
+
     k = 0
-    data = []
     failed = []
+    written = [] # codes waiting for the next write
     o = Obtain()
-    for code in codes:
-        k+=1
+    if static_fields:
+        # One batched lookup instead of one per code.
+        o.fetch_static(list(codes), static_fields)
+    flushed = True # False while a write is under way or after it failed
+    try:
+        for code in codes:
+            k+=1
+            try:
+                d = clean(o.fetch([code], fields=fields, **kwargs))
+            except:
+                print "Total failure: {}".format(code)
+                failed.append(code)
+                journal.failed([code])
+            else:
+                writer.write(d)
+                written.append(code)
+                print(1.*k/len(codes))
+                if len(set(fields)-set(d.columns))>0:
+                    print "{} missing {}".format(code, 
+                            len(set(fields)-set(d.columns)))
+            if k%10==0:
+                flushed = False
+                writer.flush()
+                flushed = True
+                journal.done(written)
+                written = []
+    finally:
         try:
-            d = clean(o.fetch([code], **kwargs))
-        except:
-            print "Total failure: {}".format(code)
-            failed.append(code)
-        else:
-            data.append(d)
-            print(1.*k/len(codes))
-            if len(set(fields)-set(d.columns))>0:
-                print "{} missing {}".format(code, len(set(f)-set(d.columns)))
-        if k%10==0 or k==len(codes):
-            if len(data)>0:
-                df = concat(data)
-                # Make sure all columns are present (may be empty)
-                for f in fields:
-                    try:
-                        df[f]
-                    except KeyError:
-                        df[f] = NaN
-
-                # Standardize column order
-                columns = df.columns.tolist()
-                columns.sort()
-                df = df[columns]
-                if k<10:
-                    # We could have file0 when there aren't many codes.
-                    k = 10
-                df.to_csv(out_dir+"file{}.tmp".format(k/10), encoding="utf-8", 
-                        index=False, header=header)
+            if flushed:
+                # Whatever is still buffered is written even after an
+                # error, and its codes are journaled once it is.
+                writer.close()
+                journal.done(written)
             else:
-                pass
-            data = []
-
+                # The rows of a failed write are gone, so their codes
+                # stay out of the journal and are fetched on resume.
+                sink.close()
+        finally:
+            journal.close()
 
     with open(out_dir+"failed.csv", 'w') as f:
         for code in failed:
             f.write(code+'\n')
-
-    call(["sh", DatastreamDir+"CombineFiles.sh", "-d", out_dir])